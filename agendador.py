@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import deque
+
+
+# Lotes rodando ao mesmo tempo no servidor, somando todas as sessões; os
+# demais esperam na fila, na ordem em que foram enviados.
+LOTES_SIMULTANEOS = int(os.environ.get("ASPDOC_LOTES_SIMULTANEOS", "2"))
+# Bytes de documentos já renderizados e ainda não entregues ao ZIP, somando
+# todos os lotes em execução.
+LIMITE_MEMORIA_LOTES = int(os.environ.get("ASPDOC_MEMORIA_LOTES_MB", "256")) * 1024 * 1024
+# Estimativa por nota até o primeiro resultado chegar (planilha + relatório).
+ESTIMATIVA_INICIAL_NOTA = 512 * 1024
+
+
+def tamanho_documentos(resultado):
+    return sum(len(conteudo) for _, conteudo in resultado["documentos"])
+
+
+class OrcamentoMemoria:
+    # Cada nota enviada ao pool reserva o tamanho médio dos documentos de uma
+    # nota; quando o resultado chega a reserva vira o tamanho real e é
+    # liberada depois que o lote o entrega ao ZIP. Uma nota sempre pode ser
+    # reservada por quem não tem nada em andamento, então nenhum lote fica
+    # parado esperando a memória de outro.
+    def __init__(self, limite=LIMITE_MEMORIA_LOTES):
+        self.limite = limite
+        self.em_uso = 0
+        self.pico = 0
+        self._media = ESTIMATIVA_INICIAL_NOTA
+        self._lock = threading.Lock()
+
+    def reservar(self, forcar=False):
+        with self._lock:
+            tamanho = self._media
+            if not forcar and self.em_uso + tamanho > self.limite:
+                return None
+            self.em_uso += tamanho
+            self.pico = max(self.pico, self.em_uso)
+            return tamanho
+
+    def ajustar(self, reservado, real):
+        with self._lock:
+            self.em_uso += real - reservado
+            self.pico = max(self.pico, self.em_uso)
+            if real:
+                self._media = max(int(self._media * 0.9 + real * 0.1), 1)
+        return real
+
+    def liberar(self, tamanho):
+        with self._lock:
+            self.em_uso -= tamanho
+
+
+class Agendador:
+    # Fila única de lotes para o processo do servidor. Entra em execução o
+    # primeiro da fila, quando há vaga e o pool de processos em uso tem o
+    # tamanho que ele pediu: trocar o tamanho do pool derrubaria os lotes que
+    # já estão usando o pool atual.
+    def __init__(self, lotes_simultaneos=LOTES_SIMULTANEOS, limite_memoria=LIMITE_MEMORIA_LOTES):
+        self.lotes_simultaneos = max(lotes_simultaneos, 1)
+        self.memoria = OrcamentoMemoria(limite_memoria)
+        self._fila = deque()
+        self._executando = {}
+        self._condicao = threading.Condition()
+
+    def _pode_executar(self, tarefa):
+        if self._fila[0] is not tarefa or len(self._executando) >= self.lotes_simultaneos:
+            return False
+        if tarefa.workers <= 1:
+            return True
+        return all(workers <= 1 or workers == tarefa.workers for workers in self._executando.values())
+
+    def aguardar_vez(self, tarefa, cancelado):
+        # Bloqueia a thread da tarefa até a vez dela; devolve False se ela
+        # for cancelada ainda na fila.
+        with self._condicao:
+            self._fila.append(tarefa)
+            while not self._pode_executar(tarefa):
+                if cancelado.is_set():
+                    self._fila.remove(tarefa)
+                    self._condicao.notify_all()
+                    return False
+                self._condicao.wait()
+            self._fila.popleft()
+            self._executando[tarefa] = tarefa.workers
+            self._condicao.notify_all()
+            return True
+
+    def liberar(self, tarefa):
+        with self._condicao:
+            self._executando.pop(tarefa, None)
+            self._condicao.notify_all()
+
+    def acordar(self):
+        with self._condicao:
+            self._condicao.notify_all()
+
+    def posicao(self, tarefa):
+        with self._condicao:
+            for posicao, na_fila in enumerate(self._fila, start=1):
+                if na_fila is tarefa:
+                    return posicao
+            return 0
+
+    def resumo(self):
+        with self._condicao:
+            return {
+                "executando": len(self._executando),
+                "na_fila": len(self._fila),
+                "lotes_simultaneos": self.lotes_simultaneos,
+                "memoria_em_uso": max(self.memoria.em_uso, 0),
+                "memoria_pico": self.memoria.pico,
+                "memoria_limite": self.memoria.limite,
+            }
+
+
+_agendador = None
+_agendador_lock = threading.Lock()
+
+
+def obter_agendador():
+    global _agendador
+    with _agendador_lock:
+        if _agendador is None:
+            _agendador = Agendador()
+        return _agendador
@@ -1,38 +1,46 @@
 import base64
-import io
-import os
 import re
-import tempfile
-import xml.etree.ElementTree as ET
-import zipfile
-from datetime import datetime
+import threading
 from decimal import Decimal
 from pathlib import Path
 
 import streamlit as st
-from docxtpl import DocxTemplate
-from num2words import num2words
+
+from agendador import obter_agendador
+from conversao_pdf import FORMATO_SAIDA_PADRAO, FORMATOS_SAIDA, obter_conversor_pdf
+from formatacao import formatar_moeda_brasileira
+from historico_notas import obter_historico
+from metricas import erros_para_csv, erros_para_json
+from pacotes_xml import eh_pacote
+from processamento import (
+    MODO_COMPRESSAO_PADRAO,
+    MODOS_COMPRESSAO,
+    aquecer_templates,
+    descrever_compressao,
+    exportar_competencia,
+    iniciar_executor,
+    numero_workers_padrao,
+    remover_xmls_duplicados,
+)
+from registro_templates import obter_registro
+from tarefas import enviar_tarefa, obter_tarefa
 
 
 BASE_DIR = Path(__file__).resolve().parent
 ASSETS_DIR = BASE_DIR / "assets"
 LOGO_PATH = ASSETS_DIR / "logo.svg"
+ESTILOS_PATH = ASSETS_DIR / "estilos.css"
 
-PALAVRAS_CHAVE_MARACANAU = {
-    "MARACANAU_SEFIN": ["FINANÇAS", "PAPEL"],
-    "MARACANAU_EDUCACAO": ["EDUCAÇÃO", "PAPEL"],
-    "MARACANAU_SAUDE": ["SAÚDE", "PAPEL"],
-    "MARACANAU_SASC": ["ALIMENTAR", "SEGURANÇA"],
-    "MARACANAU_ARQUIVO": ["ARQUIVÍSTICO", "LAPSO"],
+ROTULOS_COMPRESSAO = {
+    "armazenar": "Sem compressão (mais rápido)",
+    "rapida": "Compressão rápida",
+    "maxima": "Compressão máxima",
 }
 
-PALAVRAS_CHAVE_PACATUBA = {
-    "PACATUBA_ADM": ["PACATUBA", "ADMINISTRAÇÃO"],
-    "PACATUBA_EDUCACAO": ["PACATUBA", "EDUCAÇÃO"],
-    "PACATUBA_INFRA": ["PACATUBA", "INFRAESTRUTURA"],
-    "PACATUBA_IPMP": ["PACATUBA", "SERVIDORES"],
-    "PACATUBA_FMAS": ["PACATUBA", "HUMANOS"],
-    "PACATUBA_SAUDE": ["PACATUBA", "SAÚDE"],
+ROTULOS_FORMATO = {
+    "docx": "DOCX",
+    "pdf": "PDF",
+    "ambos": "DOCX e PDF",
 }
 
 
@@ -42,301 +50,31 @@ def carregar_svg_base64(path):
     return base64.b64encode(path.read_bytes()).decode("utf-8")
 
 
+def minificar_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};])\s*", r"\1", css).strip()
+
+
+@st.cache_resource(show_spinner=False)
+def montar_estilos():
+    # Lido e minificado uma vez por processo do servidor; cada rerun só
+    # reenvia o texto pronto.
+    return f"<style>{minificar_css(ESTILOS_PATH.read_text(encoding='utf-8'))}</style>"
+
+
 def aplicar_estilos():
-    st.markdown(
-        """
-        <style>
-        @import url('https://fonts.googleapis.com/css2?family=Playfair+Display:wght@700;900&family=Space+Grotesk:wght@300;400;500;600;700&family=JetBrains+Mono:wght@400;500;700&display=swap');
-
-        :root {{
-            --navy: #060D1A;
-            --navy2: #0C1A33;
-            --gold: #C9A84C;
-            --gold2: #E8C96A;
-            --cyan: #4FD1E0;
-            --gray: #8A96AC;
-            --line: rgba(201, 168, 76, 0.18);
-        }}
-
-        .stApp {{
-            background:
-                radial-gradient(circle at 8% 0%, rgba(201, 168, 76, 0.16), transparent 32rem),
-                radial-gradient(circle at 90% 40%, rgba(79, 209, 224, 0.11), transparent 28rem),
-                linear-gradient(rgba(201, 168, 76, 0.04) 1px, transparent 1px),
-                linear-gradient(90deg, rgba(201, 168, 76, 0.04) 1px, transparent 1px),
-                var(--navy);
-            background-size: auto, auto, 58px 58px, 58px 58px, auto;
-            color: #FFFFFF;
-            font-family: 'Space Grotesk', sans-serif;
-        }}
-
-        .stApp::before {{
-            content: "";
-            position: fixed;
-            inset: 0;
-            pointer-events: none;
-            background-image: url("data:image/svg+xml,%3Csvg viewBox='0 0 200 200' xmlns='http://www.w3.org/2000/svg'%3E%3Cfilter id='n'%3E%3CfeTurbulence type='fractalNoise' baseFrequency='0.9' numOctaves='4' stitchTiles='stitch'/%3E%3C/filter%3E%3Crect width='100%25' height='100%25' filter='url(%23n)' opacity='0.035'/%3E%3C/svg%3E");
-            opacity: 0.7;
-            z-index: 0;
-        }}
-
-        [data-testid="stHeader"], [data-testid="stToolbar"], [data-testid="stDecoration"], #MainMenu, footer {{
-            visibility: hidden;
-            height: 0;
-        }}
-
-        [data-testid="stAppViewContainer"] > .main {{
-            position: relative;
-            z-index: 1;
-        }}
-
-        .block-container {{
-            max-width: 1180px;
-            padding: 2.2rem 2rem 4rem;
-        }}
-
-        h1, h2, h3, p, label, span, div {{
-            font-family: 'Space Grotesk', sans-serif;
-        }}
-
-        .brand-shell {{
-            display: grid;
-            grid-template-columns: minmax(0, 1.15fr) minmax(320px, 0.85fr);
-            gap: 2.2rem;
-            align-items: stretch;
-            margin-bottom: 1.8rem;
-        }}
-
-        .hero-panel, .control-panel, .status-panel {{
-            position: relative;
-            overflow: hidden;
-            border: 1px solid var(--line);
-            border-radius: 14px;
-            background: linear-gradient(160deg, rgba(12, 26, 51, 0.88), rgba(6, 13, 26, 0.72));
-            box-shadow: 0 24px 70px rgba(0, 0, 0, 0.35), inset 0 0 45px rgba(201, 168, 76, 0.04);
-        }}
-
-        .hero-panel {{
-            min-height: 430px;
-            padding: 2.4rem;
-        }}
-
-        .hero-panel::after, .control-panel::after, .status-panel::after {{
-            content: "";
-            position: absolute;
-            top: 16px;
-            right: 16px;
-            width: 22px;
-            height: 22px;
-            border-top: 1px solid var(--gold);
-            border-right: 1px solid var(--gold);
-            opacity: 0.45;
-        }}
-
-        .brand-logo {{
-            width: 188px;
-            max-width: 70%;
-            margin-bottom: 2.4rem;
-        }}
-
-        .eyebrow {{
-            display: inline-flex;
-            align-items: center;
-            gap: 0.6rem;
-            color: var(--gold);
-            border: 1px solid var(--line);
-            border-radius: 999px;
-            background: rgba(201, 168, 76, 0.08);
-            padding: 0.45rem 0.85rem;
-            font-family: 'JetBrains Mono', monospace;
-            font-size: 0.72rem;
-            letter-spacing: 0.12rem;
-            text-transform: uppercase;
-        }}
-
-        .eyebrow-dot {{
-            width: 7px;
-            height: 7px;
-            border-radius: 999px;
-            background: var(--cyan);
-            box-shadow: 0 0 12px rgba(79, 209, 224, 0.9);
-        }}
-
-        .hero-title {{
-            margin: 1.4rem 0 1rem;
-            max-width: 720px;
-            font-family: 'Playfair Display', serif;
-            font-size: clamp(2.4rem, 5vw, 4.6rem);
-            font-weight: 900;
-            line-height: 1.03;
-            letter-spacing: 0;
-            color: #FFFFFF;
-        }}
-
-        .hero-title span {{
-            font-family: 'Playfair Display', serif;
-            color: var(--gold2);
-            text-shadow: 0 0 26px rgba(201, 168, 76, 0.32);
-        }}
-
-        .hero-sub {{
-            max-width: 620px;
-            color: var(--gray);
-            font-size: 1.04rem;
-            line-height: 1.7;
-        }}
-
-        .hero-metrics {{
-            display: grid;
-            grid-template-columns: repeat(3, minmax(0, 1fr));
-            gap: 0.9rem;
-            margin-top: 2.2rem;
-        }}
-
-        .metric-card {{
-            border: 1px solid rgba(201, 168, 76, 0.12);
-            border-radius: 10px;
-            background: rgba(255, 255, 255, 0.025);
-            padding: 1rem;
-        }}
-
-        .metric-card strong {{
-            display: block;
-            color: var(--gold);
-            font-family: 'JetBrains Mono', monospace;
-            font-size: 1.25rem;
-            margin-bottom: 0.25rem;
-        }}
-
-        .metric-card span {{
-            color: var(--gray);
-            font-size: 0.78rem;
-        }}
-
-        .control-panel {{
-            padding: 1.6rem;
-        }}
-
-        .panel-title {{
-            color: #FFFFFF;
-            font-size: 1.05rem;
-            font-weight: 700;
-            margin: 0 0 0.3rem;
-        }}
-
-        .panel-copy {{
-            color: var(--gray);
-            font-size: 0.88rem;
-            line-height: 1.55;
-            margin-bottom: 1.2rem;
-        }}
-
-        .scan-card {{
-            margin-top: 1.2rem;
-            border: 1px solid rgba(79, 209, 224, 0.2);
-            border-radius: 12px;
-            padding: 1rem;
-            background: rgba(79, 209, 224, 0.045);
-        }}
-
-        .scan-card code {{
-            color: var(--cyan);
-            background: transparent;
-            font-family: 'JetBrains Mono', monospace;
-        }}
-
-        .file-chip {{
-            display: inline-flex;
-            align-items: center;
-            margin: 0.2rem 0.25rem 0.2rem 0;
-            padding: 0.42rem 0.72rem;
-            border-radius: 999px;
-            border: 1px solid rgba(201, 168, 76, 0.18);
-            color: #F5F0E8;
-            background: rgba(201, 168, 76, 0.07);
-            font-size: 0.78rem;
-            font-family: 'JetBrains Mono', monospace;
-        }}
-
-        .status-panel {{
-            padding: 1.4rem;
-            margin-top: 1.4rem;
-        }}
-
-        .stRadio [role="radiogroup"] {{
-            gap: 0.6rem;
-        }}
-
-        .stFileUploader {{
-            border: 1px dashed rgba(201, 168, 76, 0.32);
-            border-radius: 12px;
-            padding: 0.5rem 0.7rem 0.1rem;
-            background: rgba(255, 255, 255, 0.025);
-        }}
-
-        .stFileUploader label, .stRadio label {{
-            color: #F5F0E8 !important;
-            font-weight: 600;
-        }}
-
-        .stButton > button, .stDownloadButton > button {{
-            width: 100%;
-            min-height: 3rem;
-            border: 1px solid rgba(201, 168, 76, 0.28);
-            border-radius: 7px;
-            background: linear-gradient(135deg, var(--gold), var(--gold2));
-            color: var(--navy);
-            font-weight: 800;
-            box-shadow: 0 0 26px rgba(201, 168, 76, 0.32);
-        }}
-
-        .stButton > button:hover, .stDownloadButton > button:hover {{
-            border-color: var(--gold2);
-            color: var(--navy);
-            box-shadow: 0 0 34px rgba(201, 168, 76, 0.45);
-            transform: translateY(-1px);
-        }}
-
-        .stAlert {{
-            border-radius: 10px;
-            border: 1px solid rgba(201, 168, 76, 0.18);
-            background: rgba(12, 26, 51, 0.75);
-        }}
-
-        div[data-testid="stStatusWidget"] {{
-            visibility: hidden;
-            height: 0;
-        }}
-
-        @media (max-width: 880px) {{
-            .block-container {{
-                padding: 1.2rem 1rem 3rem;
-            }}
-            .brand-shell {{
-                grid-template-columns: 1fr;
-            }}
-            .hero-panel {{
-                min-height: auto;
-                padding: 1.5rem;
-            }}
-            .hero-metrics {{
-                grid-template-columns: 1fr;
-            }}
-        }}
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
+    st.markdown(montar_estilos(), unsafe_allow_html=True)
 
 
-def renderizar_hero():
+@st.cache_resource(show_spinner=False)
+def montar_hero():
     logo_b64 = carregar_svg_base64(LOGO_PATH)
     logo_html = ""
     if logo_b64:
         logo_html = f'<img src="data:image/svg+xml;base64,{logo_b64}" alt="ASPdoc" class="brand-logo">'
 
-    st.markdown(
-        f"""
+    return f"""
         <section class="hero-panel">
             {logo_html}
             <div class="eyebrow"><span class="eyebrow-dot"></span>GED ASP // automação documental</div>
@@ -352,9 +90,27 @@ def renderizar_hero():
                 <div class="metric-card"><strong>ZIP</strong><span>Entrega consolidada para download.</span></div>
             </div>
         </section>
-        """,
-        unsafe_allow_html=True,
-    )
+        """
+
+
+def renderizar_hero():
+    st.markdown(montar_hero(), unsafe_allow_html=True)
+
+
+@st.cache_resource(show_spinner=False)
+def preparar_servidor():
+    # Roda uma vez por processo do servidor, antes do primeiro lote. Os
+    # templates (e com eles o docxtpl) carregam numa thread: a página abre
+    # sem esperar, e um lote enviado antes disso carrega o que precisar.
+    relatorio = {"templates": 0, "erros": [], "duracao_s": None}
+    threading.Thread(
+        target=lambda: relatorio.update(aquecer_templates()), name="aspdoc-aquecimento", daemon=True
+    ).start()
+    iniciar_executor(numero_workers_padrao())
+    obter_conversor_pdf().aquecer()
+    # Fila de lotes compartilhada por todas as sessões deste servidor.
+    obter_agendador()
+    return relatorio
 
 
 def renderizar_cabecalho_controles():
@@ -372,190 +128,6 @@ def renderizar_cabecalho_controles():
     )
 
 
-def formatar_moeda_brasileira(valor):
-    valor_str = f"{valor:,.2f}"
-    return f"R$ {valor_str.replace('.', ',').replace(',', '.', 1)}"
-
-
-def decimal_para_extenso(valor):
-    parte_inteira = int(valor)
-    centavos = int(round((valor % 1) * 100))
-    extenso = num2words(parte_inteira, lang="pt_BR") + " reais"
-    if centavos > 0:
-        extenso += " e " + num2words(centavos, lang="pt_BR") + " centavos"
-    return extenso.capitalize()
-
-
-def formatar_competencia(competencia):
-    data_obj = datetime.strptime(competencia, "%Y-%m-%d")
-    meses_pt = {
-        1: "Janeiro",
-        2: "Fevereiro",
-        3: "Março",
-        4: "Abril",
-        5: "Maio",
-        6: "Junho",
-        7: "Julho",
-        8: "Agosto",
-        9: "Setembro",
-        10: "Outubro",
-        11: "Novembro",
-        12: "Dezembro",
-    }
-    return f"{meses_pt[data_obj.month]} {data_obj.year}"
-
-
-def extrair_informacoes_xml(xml_file):
-    try:
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        infNfse = root.find(".//InfNfse")
-        if infNfse is None:
-            print(f"Aviso: tag 'InfNfse' não encontrada no XML {xml_file}.")
-            return None
-
-        numero_nf = infNfse.find(".//Numero")
-        data = infNfse.find(".//DataEmissao")
-        valor = infNfse.find(".//ValorServicos")
-        competencia = infNfse.find(".//Competencia")
-        discriminacao = infNfse.find(".//Discriminacao")
-
-        numero_nf = numero_nf.text if numero_nf is not None else "N/A"
-        data = data.text if data is not None else None
-        valor = Decimal(valor.text) if valor is not None else None
-        competencia = competencia.text if competencia is not None else None
-        discriminacao_text = discriminacao.text if discriminacao is not None else ""
-
-        match_quant = re.search(r"(\d+)\s+R\$", discriminacao_text)
-        quant = match_quant.group(1) if match_quant else "N/A"
-
-        data_formatada = "N/A"
-        competencia_formatada = "N/A"
-        if data:
-            try:
-                data_obj = datetime.strptime(data, "%Y-%m-%d")
-                meses_pt = {
-                    1: "Janeiro",
-                    2: "Fevereiro",
-                    3: "Março",
-                    4: "Abril",
-                    5: "Maio",
-                    6: "Junho",
-                    7: "Julho",
-                    8: "Agosto",
-                    9: "Setembro",
-                    10: "Outubro",
-                    11: "Novembro",
-                    12: "Dezembro",
-                }
-                data_formatada = f"{data_obj.day} de {meses_pt[data_obj.month]} de {data_obj.year}"
-            except ValueError:
-                print(f"Aviso: data inválida no XML {xml_file}.")
-
-        if competencia:
-            try:
-                competencia_formatada = formatar_competencia(competencia)
-            except ValueError:
-                print(f"Aviso: competência inválida no XML {xml_file}.")
-
-        return {
-            "numeroNF": numero_nf,
-            "data": data_formatada,
-            "valor": formatar_moeda_brasileira(valor) if valor else "N/A",
-            "valor_extenso": decimal_para_extenso(valor) if valor else "N/A",
-            "competencia": competencia_formatada,
-            "discriminacao": discriminacao_text,
-            "quant": quant,
-        }
-    except Exception as e:
-        print(f"Erro ao processar o XML {xml_file}: {str(e)}")
-        return None
-
-
-def identificar_template(dados, palavras_chave):
-    discriminacao = dados["discriminacao"].upper()
-    for template, palavras in palavras_chave.items():
-        if all(palavra.upper() in discriminacao for palavra in palavras):
-            return template
-    return None
-
-
-def gerar_documentos(template_dir, dados, xml_file_name):
-    arquivos_gerados = []
-    templates = ["Planilha.docx", "Relatorio.docx"]
-    for template_name in templates:
-        template_path = os.path.join(template_dir, template_name)
-        if not os.path.exists(template_path):
-            print(f"Template '{template_path}' não encontrado. Pulando...")
-            continue
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as temp_file:
-            destino_path = temp_file.name
-
-        doc = DocxTemplate(template_path)
-        doc.render(dados)
-        doc.save(destino_path)
-        print(f"Documento gerado: {destino_path}")
-        arquivos_gerados.append(destino_path)
-    return arquivos_gerados
-
-
-def processar_todos_xmls(xml_dir, templates_base_dir, palavras_chave):
-    resultados = []
-    for xml_file in os.listdir(xml_dir):
-        if xml_file.endswith(".xml"):
-            xml_path = os.path.join(xml_dir, xml_file)
-            dados = extrair_informacoes_xml(xml_path)
-            if dados is None:
-                print(f"Pulando o arquivo {xml_file} devido a erros.")
-                continue
-
-            template_folder = identificar_template(dados, palavras_chave)
-            if template_folder is None:
-                print(f"Nenhum template correspondente encontrado para {xml_file}. Pulando...")
-                continue
-
-            template_dir = os.path.join(templates_base_dir, template_folder)
-            arquivos_gerados = gerar_documentos(template_dir, dados, xml_file)
-            resultados.extend(arquivos_gerados)
-    return resultados
-
-
-def gerar_documentos_em_memoria(template_dir, dados, xml_file_name):
-    arquivos_gerados = []
-    templates = ["Planilha.docx", "Relatorio.docx"]
-
-    for template_name in templates:
-        template_path = os.path.join(template_dir, template_name)
-        if not os.path.exists(template_path):
-            st.warning(f"Template '{template_path}' não encontrado. Pulando...")
-            continue
-
-        try:
-            output_filename = f"{os.path.splitext(xml_file_name)[0]}_{template_name}"
-            with io.BytesIO() as temp_file:
-                doc = DocxTemplate(template_path)
-                doc.render(dados)
-                doc.save(temp_file)
-                temp_file.seek(0)
-                arquivos_gerados.append((output_filename, temp_file.read()))
-        except Exception as e:
-            st.error(f"Erro ao gerar documento '{template_name}': {e}")
-            continue
-
-    return arquivos_gerados
-
-
-def criar_zip_em_memoria(arquivos_gerados):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for nome_arquivo, conteudo in arquivos_gerados:
-            zip_file.writestr(nome_arquivo, conteudo)
-    zip_buffer.seek(0)
-    return zip_buffer
-
-
 def renderizar_arquivos_carregados(uploaded_files):
     if not uploaded_files:
         st.markdown(
@@ -576,64 +148,233 @@ def renderizar_arquivos_carregados(uploaded_files):
     )
 
 
-def processar_xmls(cidade, arquivos, palavras_chave):
+def renderizar_metricas(coletor, cidade):
+    with st.expander(f"Tempos por etapa · {coletor.duracao:.1f} s no total"):
+        st.dataframe(coletor.resumo(), hide_index=True, use_container_width=True)
+        json_col, csv_col = st.columns(2)
+        with json_col:
+            st.download_button(
+                label="Exportar tempos (JSON)",
+                data=coletor.para_json(),
+                file_name=f"tempos_{cidade.lower()}.json",
+                mime="application/json",
+                on_click="ignore",
+            )
+        with csv_col:
+            st.download_button(
+                label="Exportar tempos (CSV)",
+                data=coletor.para_csv(),
+                file_name=f"tempos_{cidade.lower()}.csv",
+                mime="text/csv",
+                on_click="ignore",
+            )
+
+
+def renderizar_avisos(avisos):
+    if avisos:
+        with st.expander(f"{len(avisos)} aviso(s)"):
+            st.markdown("\n".join(f"- {aviso}" for aviso in avisos))
+
+
+def renderizar_erros(erros, tarefa):
+    if not erros:
+        return
+    with st.expander(f"Relatório de erros · {len(erros)} ocorrência(s)"):
+        st.dataframe(erros, hide_index=True, use_container_width=True)
+        json_col, csv_col = st.columns(2)
+        with json_col:
+            st.download_button(
+                label="Exportar erros (JSON)",
+                data=erros_para_json(erros),
+                file_name=f"erros_{tarefa.cidade.lower()}.json",
+                mime="application/json",
+                on_click="ignore",
+                key=f"erros_json_{tarefa.id}",
+            )
+        with csv_col:
+            st.download_button(
+                label="Exportar erros (CSV)",
+                data=erros_para_csv(erros),
+                file_name=f"erros_{tarefa.cidade.lower()}.csv",
+                mime="text/csv",
+                on_click="ignore",
+                key=f"erros_csv_{tarefa.id}",
+            )
+
+
+def renderizar_historico(cidade, compressao):
+    historico = obter_historico()
+    if historico is None:
+        return
+    totais = historico.totais_por_competencia(cidade.nome)
+    if not totais:
+        return
+    with st.expander("Histórico de notas processadas"):
+        st.dataframe(
+            [
+                {
+                    "Competência": total["competencia"] or "sem competência",
+                    "Secretaria": total["secretaria"],
+                    "Notas": total["notas"],
+                    "Valor": formatar_moeda_brasileira(Decimal(total["valor_centavos"] or 0) / 100),
+                }
+                for total in totais
+            ],
+            hide_index=True,
+            use_container_width=True,
+        )
+        competencia = st.selectbox(
+            "Competência",
+            historico.competencias(cidade.nome),
+            format_func=lambda competencia: competencia or "sem competência",
+        )
+
+        def montar_zip():
+            # Só roda no clique: o ZIP sai dos documentos já guardados.
+            return exportar_competencia(historico, cidade.nome, competencia, compressao).ler()
+
+        st.download_button(
+            label="Baixar documentos da competência",
+            data=montar_zip,
+            file_name=f"documentos_{cidade.nome.lower()}_{competencia or 'sem_competencia'}.zip",
+            mime="application/zip",
+            on_click="ignore",
+        )
+
+
+def iniciar_processamento(
+    cidade,
+    arquivos,
+    workers=None,
+    perfil=False,
+    compressao=MODO_COMPRESSAO_PADRAO,
+    consolidar=False,
+    formato=FORMATO_SAIDA_PADRAO,
+    pular_processadas=False,
+):
+    # getbuffer() expõe o conteúdo do upload sem cópia; a leitura da NFS-e
+    # consome o memoryview direto, na ordem em que os arquivos chegaram.
+    xmls, duplicados = remover_xmls_duplicados(
+        (uploaded_file.name, uploaded_file.getbuffer())
+        for uploaded_file in arquivos
+        if uploaded_file.name.lower().endswith(".xml") or eh_pacote(uploaded_file.name)
+    )
+    avisos = [
+        f"{xml_file_name} ignorado: conteúdo idêntico a {original}."
+        for xml_file_name, original in duplicados
+    ]
+    tarefa = enviar_tarefa(
+        cidade.nome,
+        xmls,
+        cidade.diretorio,
+        cidade.palavras_chave,
+        workers,
+        perfil,
+        avisos,
+        compressao,
+        consolidar,
+        formato,
+        pular_processadas,
+        anterior_id=st.session_state.get("tarefa_id"),
+    )
+    st.session_state["tarefa_id"] = tarefa.id
+    return tarefa
+
+
+def renderizar_identificados(identificados):
+    if identificados:
+        st.markdown(
+            "<br>".join(f"<code>{item}</code>" for item in identificados),
+            unsafe_allow_html=True,
+        )
+
+
+@st.fragment(run_every=1)
+def acompanhar_tarefa(tarefa):
+    if not tarefa.ativa:
+        # Sai do polling e redesenha a página com o resultado final.
+        st.rerun()
+
+    estado = tarefa.instantaneo()
     st.markdown('<section class="status-panel">', unsafe_allow_html=True)
-    st.markdown(f'<p class="panel-title">Processamento: {cidade.title()}</p>', unsafe_allow_html=True)
-
-    progress = st.progress(0, text="Preparando arquivos...")
-    detalhes = st.empty()
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        try:
-            for uploaded_file in arquivos:
-                file_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-
-            templates_base_dir = os.path.abspath(cidade.upper())
-            xmls = [xml_file for xml_file in os.listdir(temp_dir) if xml_file.endswith(".xml")]
-            arquivos_gerados = []
-            identificados = []
-
-            for index, xml_file in enumerate(xmls, start=1):
-                progress.progress(index / max(len(xmls), 1), text=f"Lendo {xml_file}...")
-                xml_path = os.path.join(temp_dir, xml_file)
-                dados = extrair_informacoes_xml(xml_path)
-                if dados is None:
-                    st.warning(f"Pulando {xml_file}: não foi possível ler a NFS-e.")
-                    continue
-
-                template_folder = identificar_template(dados, palavras_chave)
-                if template_folder is None:
-                    st.warning(f"Nenhum template correspondente encontrado para {xml_file}.")
-                    continue
-
-                identificados.append(f"{xml_file} -> {template_folder}")
-                detalhes.markdown(
-                    "<br>".join(f"<code>{item}</code>" for item in identificados),
-                    unsafe_allow_html=True,
-                )
+    st.markdown(f'<p class="panel-title">Processamento: {tarefa.cidade.title()}</p>', unsafe_allow_html=True)
 
-                template_dir = os.path.join(templates_base_dir, template_folder)
-                arquivos_gerados.extend(gerar_documentos_em_memoria(template_dir, dados, xml_file))
-
-            if arquivos_gerados:
-                progress.progress(1.0, text="ZIP pronto para download.")
-                zip_buffer = criar_zip_em_memoria(arquivos_gerados)
-                st.success(f"{len(arquivos_gerados)} documento(s) gerado(s) com sucesso.")
-                st.download_button(
-                    label="Baixar documentos em ZIP",
-                    data=zip_buffer.getvalue(),
-                    file_name=f"documentos_{cidade.lower()}.zip",
-                    mime="application/zip",
-                    type="primary",
-                )
-            else:
-                progress.empty()
-                st.warning("Nenhum arquivo foi processado. Verifique os XMLs e as palavras-chave.")
-        except Exception as e:
-            progress.empty()
-            st.error(f"Erro ao processar XMLs: {str(e)}")
+    if estado["estado"] == "na_fila":
+        resumo = tarefa.agendador.resumo()
+        st.info(
+            f"Na fila: posição {estado['posicao_fila']} de {resumo['na_fila']}. "
+            f"{resumo['executando']} lote(s) em processamento no servidor; o seu começa em seguida."
+        )
+        st.button("Cancelar processamento", on_click=tarefa.cancelar, key=f"cancelar_{tarefa.id}")
+        st.markdown("</section>", unsafe_allow_html=True)
+        return
+
+    if estado["notas_concluidas"]:
+        texto = f"{estado['notas_concluidas']} nota(s) concluída(s) · {estado['ultimo_arquivo']}"
+    else:
+        texto = "Preparando arquivos..."
+    st.progress(min(estado["arquivos_lidos"] / max(estado["total_arquivos"], 1), 1.0), text=texto)
+    cancelar_col, parcial_col = st.columns(2)
+    with cancelar_col:
+        st.button("Cancelar processamento", on_click=tarefa.cancelar, key=f"cancelar_{tarefa.id}")
+    with parcial_col:
+        # O lote continua; o download leva só o que já foi gravado no ZIP.
+        st.download_button(
+            label=f"Baixar parcial ({estado['documentos_gravados']} documento(s))",
+            data=tarefa.zip_saida.ler_parcial,
+            file_name=f"documentos_{tarefa.cidade.lower()}_parcial.zip",
+            mime="application/zip",
+            on_click="ignore",
+            disabled=not estado["documentos_gravados"],
+            key=f"parcial_{tarefa.id}",
+        )
+    if estado["avisos"] or estado["erros"]:
+        st.caption(f"{len(estado['avisos'])} aviso(s) e {len(estado['erros'])} erro(s) até agora.")
+    renderizar_identificados(estado["identificados"])
+
+    st.markdown("</section>", unsafe_allow_html=True)
+
+
+def renderizar_resultado_tarefa(tarefa):
+    estado = tarefa.instantaneo()
+    st.markdown('<section class="status-panel">', unsafe_allow_html=True)
+    st.markdown(f'<p class="panel-title">Processamento: {tarefa.cidade.title()}</p>', unsafe_allow_html=True)
+
+    if estado["estado"] == "erro":
+        st.error(f"Erro ao processar XMLs: {estado['erro']}")
+    elif estado["estado"] == "cancelada":
+        st.info(f"Processamento cancelado após {estado['notas_concluidas']} nota(s).")
+
+    if tarefa.zip_saida is not None and tarefa.zip_saida.total_documentos:
+        if estado["estado"] == "concluida":
+            st.progress(1.0, text="ZIP pronto para download.")
+            mensagem = f"{tarefa.zip_saida.total_documentos} documento(s) gerado(s) com sucesso."
+            if estado["documentos_em_cache"]:
+                mensagem += f" {estado['documentos_em_cache']} reaproveitado(s) do cache."
+            st.success(mensagem)
+        else:
+            st.caption(
+                f"{tarefa.zip_saida.total_documentos} documento(s) gerado(s) antes da interrupção "
+                "continuam disponíveis no ZIP."
+            )
+        st.caption(f"ZIP: {descrever_compressao(tarefa.zip_saida)}.")
+        st.download_button(
+            label="Baixar documentos em ZIP",
+            data=tarefa.zip_saida.ler,
+            file_name=f"documentos_{tarefa.cidade.lower()}.zip",
+            mime="application/zip",
+            on_click="ignore",
+            type="primary",
+            key=f"baixar_{tarefa.id}",
+        )
+    elif estado["estado"] == "concluida":
+        st.warning("Nenhum arquivo foi processado. Verifique os XMLs e as palavras-chave.")
+
+    renderizar_avisos(estado["avisos"])
+    renderizar_erros(estado["erros"], tarefa)
+    renderizar_identificados(estado["identificados"])
+    if tarefa.coletor is not None:
+        renderizar_metricas(tarefa.coletor, tarefa.cidade)
 
     st.markdown("</section>", unsafe_allow_html=True)
 
@@ -646,6 +387,14 @@ def main():
         initial_sidebar_state="collapsed",
     )
     aplicar_estilos()
+    preparo = preparar_servidor()
+    # Recarregado sozinho quando uma pasta ou manifesto muda.
+    registro = obter_registro()
+    if not registro.cidades:
+        st.error("Nenhum município com templates encontrado. Verifique os arquivos manifesto.json.")
+        return
+    # O lote roda fora do script; a sessão só guarda qual tarefa acompanhar.
+    tarefa = obter_tarefa(st.session_state.get("tarefa_id"))
 
     hero_col, control_col = st.columns([1.15, 0.85], gap="large")
 
@@ -654,20 +403,82 @@ def main():
 
     with control_col:
         renderizar_cabecalho_controles()
-        cidade = st.radio(
+        nome_cidade = st.radio(
             "Município",
-            ["MARACANAU", "PACATUBA"],
+            registro.nomes,
             horizontal=True,
-            captions=["Templates Maracanaú", "Templates Pacatuba"],
+            captions=[f"Templates {cidade.rotulo}" for cidade in registro.cidades.values()],
         )
+        cidade = registro.cidades[nome_cidade]
         uploaded_files = st.file_uploader(
             "Upload dos XMLs da NFS-e",
             accept_multiple_files=True,
-            type="xml",
-            help="Você pode selecionar vários XMLs de uma vez.",
+            type=["xml", "zip", "tar.gz", "tgz"],
+            help="Você pode selecionar vários XMLs de uma vez ou enviar um pacote .zip ou .tar.gz com os XMLs.",
         )
         renderizar_arquivos_carregados(uploaded_files)
-        processar = st.button("Processar documentos", type="primary", use_container_width=True)
+        consolidar = st.toggle(
+            "Consolidar por secretaria",
+            help=(
+                "Gera uma Planilha e um Relatorio por secretaria com todas as notas do lote "
+                "(uma linha por nota e o total), em vez de um par de documentos por nota."
+            ),
+        )
+        formato = st.radio(
+            "Formato dos documentos",
+            FORMATOS_SAIDA,
+            index=FORMATOS_SAIDA.index(FORMATO_SAIDA_PADRAO),
+            horizontal=True,
+            format_func=lambda formato: ROTULOS_FORMATO[formato],
+        )
+        if formato != "docx" and not obter_conversor_pdf().disponivel:
+            st.caption("LibreOffice não está instalado neste servidor; os documentos sairão em DOCX.")
+        pular_processadas = st.toggle(
+            "Pular notas já processadas",
+            disabled=obter_historico() is None,
+            help=(
+                "Notas com o mesmo número e o mesmo conteúdo de um lote anterior deste município "
+                "não geram documentos de novo. Desligado, elas são geradas com um aviso."
+            ),
+        )
+        with st.expander("Opções avançadas"):
+            workers = st.number_input(
+                "Processos em paralelo",
+                min_value=1,
+                max_value=max(numero_workers_padrao() * 2, 1),
+                value=numero_workers_padrao(),
+                help="Quantidade de processos usados para ler os XMLs e gerar os documentos.",
+            )
+            compressao = st.selectbox(
+                "Compressão do ZIP",
+                list(MODOS_COMPRESSAO),
+                index=list(MODOS_COMPRESSAO).index(MODO_COMPRESSAO_PADRAO),
+                format_func=lambda modo: ROTULOS_COMPRESSAO[modo],
+                help="Os DOCX já são comprimidos; comprimir de novo reduz pouco o ZIP e leva mais tempo.",
+            )
+            perfil = st.checkbox(
+                "Gerar perfil de desempenho",
+                help=(
+                    "Roda o lote em um único processo com cProfile e tracemalloc e inclui os relatórios "
+                    "na pasta _perfil do ZIP. Deixa o processamento mais lento."
+                ),
+            )
+            if preparo["duracao_s"] is None:
+                st.caption("Carregando os templates em segundo plano...")
+            else:
+                st.caption(
+                    f"{preparo['templates']} template(s) carregado(s) em {preparo['duracao_s']:.1f} s "
+                    "na inicialização do servidor."
+                )
+        renderizar_historico(cidade, compressao)
+        for erro in registro.erros + preparo["erros"]:
+            st.error(erro)
+        processar = st.button(
+            "Processar documentos",
+            type="primary",
+            use_container_width=True,
+            disabled=tarefa is not None and tarefa.ativa,
+        )
 
     st.markdown(
         """
@@ -687,8 +498,16 @@ def main():
             st.warning("Envie pelo menos um XML antes de processar.")
             return
 
-        palavras = PALAVRAS_CHAVE_MARACANAU if cidade == "MARACANAU" else PALAVRAS_CHAVE_PACATUBA
-        processar_xmls(cidade, uploaded_files, palavras)
+        tarefa = iniciar_processamento(
+            cidade, uploaded_files, int(workers), perfil, compressao, consolidar, formato, pular_processadas
+        )
+
+    if tarefa is None:
+        return
+    if tarefa.ativa:
+        acompanhar_tarefa(tarefa)
+    else:
+        renderizar_resultado_tarefa(tarefa)
 
 
 if __name__ == "__main__":
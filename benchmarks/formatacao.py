@@ -0,0 +1,94 @@
+import argparse
+import random
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from num2words import num2words
+
+import formatacao
+
+
+def _moeda_antes(valor):
+    valor_str = f"{valor:,.2f}"
+    return f"R$ {valor_str.replace('.', ',').replace(',', '.', 1)}"
+
+
+def _extenso_antes(valor):
+    parte_inteira = int(valor)
+    centavos = int(round((valor % 1) * 100))
+    extenso = num2words(parte_inteira, lang="pt_BR") + " reais"
+    if centavos > 0:
+        extenso += " e " + num2words(centavos, lang="pt_BR") + " centavos"
+    return extenso.capitalize()
+
+
+def _data_antes(data):
+    data_obj = datetime.strptime(data, "%Y-%m-%d")
+    meses_pt = {
+        1: "Janeiro", 2: "Fevereiro", 3: "Março", 4: "Abril", 5: "Maio", 6: "Junho",
+        7: "Julho", 8: "Agosto", 9: "Setembro", 10: "Outubro", 11: "Novembro", 12: "Dezembro",
+    }
+    return f"{data_obj.day} de {meses_pt[data_obj.month]} de {data_obj.year}"
+
+
+def _competencia_antes(competencia):
+    data_obj = datetime.strptime(competencia, "%Y-%m-%d")
+    meses_pt = {
+        1: "Janeiro", 2: "Fevereiro", 3: "Março", 4: "Abril", 5: "Maio", 6: "Junho",
+        7: "Julho", 8: "Agosto", 9: "Setembro", 10: "Outubro", 11: "Novembro", 12: "Dezembro",
+    }
+    return f"{meses_pt[data_obj.month]} {data_obj.year}"
+
+
+def formatar_nota_antes(valor, data, competencia):
+    return _moeda_antes(valor), _extenso_antes(valor), _data_antes(data), _competencia_antes(competencia)
+
+
+def formatar_nota_depois(valor, data, competencia):
+    return (
+        formatacao.formatar_moeda_brasileira(valor),
+        formatacao.decimal_para_extenso(valor),
+        formatacao.formatar_data_extenso(data),
+        formatacao.formatar_competencia(competencia),
+    )
+
+
+def gerar_notas(quantidade, semente):
+    # Um lote de fechamento mensal: valores recorrentes por secretaria e
+    # poucas datas distintas, como nos lotes reais.
+    aleatorio = random.Random(semente)
+    valores_base = [Decimal(aleatorio.randint(100, 250_000)) / 100 for _ in range(40)]
+    notas = []
+    for _ in range(quantidade):
+        valor = aleatorio.choice(valores_base) if aleatorio.random() < 0.7 else Decimal(aleatorio.randint(100, 9_999_999)) / 100
+        data = f"2024-03-{aleatorio.randint(1, 28):02d}"
+        notas.append((valor, data, "2024-03-01"))
+    return notas
+
+
+def medir(funcao, notas):
+    inicio = time.perf_counter()
+    for valor, data, competencia in notas:
+        funcao(valor, data, competencia)
+    return (time.perf_counter() - inicio) / len(notas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Custo de formatação por nota, antes e depois do módulo formatacao.")
+    parser.add_argument("--notas", type=int, default=5000)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    notas = gerar_notas(args.notas, args.semente)
+    antes = medir(formatar_nota_antes, notas)
+    depois = medir(formatar_nota_depois, notas)
+
+    print(f"notas: {len(notas)}")
+    print(f"antes:  {antes * 1e6:9.1f} us/nota")
+    print(f"depois: {depois * 1e6:9.1f} us/nota")
+    print(f"ganho:  {antes / depois:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
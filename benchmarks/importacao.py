@@ -0,0 +1,79 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORCAMENTO_PADRAO_MS = float(os.environ.get("ASPDOC_ORCAMENTO_IMPORTACAO_MS", "1000"))
+# Dependências que só o processamento usa: importar o app não pode trazê-las.
+MODULOS_SOB_DEMANDA = ("docxtpl", "docx", "num2words", "cache_templates")
+
+PADRAO_LINHA = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def importar_a_frio(modulo):
+    # Um interpretador novo por medição: nada vem do sys.modules de antes.
+    processo = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {modulo}"],
+        cwd=BASE_DIR,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if processo.returncode != 0:
+        raise SystemExit(f"Falha ao importar {modulo}:\n{processo.stderr[-2000:]}")
+    linhas = []
+    for linha in processo.stderr.splitlines():
+        correspondencia = PADRAO_LINHA.match(linha)
+        if correspondencia:
+            proprio, acumulado, recuo, nome = correspondencia.groups()
+            linhas.append((nome, int(proprio) / 1000, int(acumulado) / 1000, len(recuo) // 2))
+    return linhas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tempo de importação a frio do app, por módulo, com orçamento para a inicialização."
+    )
+    parser.add_argument("--modulo", default="app")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--orcamento-ms", type=float, default=ORCAMENTO_PADRAO_MS)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args(argv)
+
+    medicoes = [importar_a_frio(args.modulo) for _ in range(max(args.repeticoes, 1))]
+    totais = [next(acumulado for nome, _, acumulado, _ in linhas if nome == args.modulo) for linhas in medicoes]
+    total = statistics.median(totais)
+    linhas = medicoes[totais.index(total)]
+
+    print(
+        f"importação de {args.modulo}: {total:.1f} ms "
+        f"(mediana de {len(totais)}; orçamento {args.orcamento_ms:.0f} ms)"
+    )
+    print(f"{'módulo':<40} {'nível':>5} {'próprio ms':>10} {'acumulado ms':>13}")
+    # O -X importtime lista os filhos antes do pai: a árvore do módulo são
+    # as linhas com recuo logo acima dele.
+    fim = next(indice for indice, linha in enumerate(linhas) if linha[0] == args.modulo)
+    inicio = fim
+    while inicio > 0 and linhas[inicio - 1][3] > 0:
+        inicio -= 1
+    arvore = [linha for linha in linhas[inicio:fim + 1] if linha[3] <= 2]
+    for nome, proprio, acumulado, nivel in sorted(arvore, key=lambda linha: -linha[2])[: args.top]:
+        print(f"{nome:<40} {nivel:5d} {proprio:10.1f} {acumulado:13.1f}")
+
+    falhas = []
+    if total > args.orcamento_ms:
+        falhas.append(f"a importação levou {total:.1f} ms, acima do orçamento de {args.orcamento_ms:.0f} ms")
+    carregados = sorted({nome for nome, _, _, _ in linhas} & set(MODULOS_SOB_DEMANDA))
+    if carregados:
+        falhas.append(f"módulos que deveriam ser importados sob demanda: {', '.join(carregados)}")
+    for falha in falhas:
+        print(f"ERRO: {falha}", file=sys.stderr)
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
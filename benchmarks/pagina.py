@@ -0,0 +1,70 @@
+import argparse
+import os
+import statistics
+import time
+
+from streamlit import config
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.testing.v1 import AppTest
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(BASE_DIR, "app.py")
+FONTES_EXTERNAS = ("fonts.googleapis.com", "fonts.gstatic.com")
+
+
+def _elementos(no):
+    filhos = getattr(no, "children", None)
+    if not filhos:
+        yield no
+        return
+    for filho in filhos.values():
+        yield from _elementos(filho)
+
+
+def medir_pagina(app_test):
+    # Bytes dos elementos que o servidor manda ao navegador a cada rerun:
+    # a soma das mensagens protobuf de todos os elementos da página. Os
+    # elementos acima de global.minCachedMessageSize já estão no cache do
+    # navegador depois da primeira execução e vão só como referência.
+    limite = int(config.get_option("global.minCachedMessageSize"))
+    referencia = len(ForwardMsg(ref_hash="0" * 32).SerializeToString())
+    total = 0
+    externos = 0
+    for elemento in _elementos(app_test._tree):
+        proto = getattr(elemento, "proto", None)
+        if proto is None:
+            continue
+        mensagem = proto.SerializeToString()
+        total += len(mensagem) if len(mensagem) < limite else referencia
+        externos += sum(mensagem.count(host.encode("utf-8")) for host in FONTES_EXTERNAS)
+    return total, externos
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tempo de execução do script e bytes enviados por rerun da página.")
+    parser.add_argument("--reruns", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    app_test = AppTest.from_file(APP_PATH, default_timeout=120)
+    inicio = time.perf_counter()
+    app_test.run()
+    primeira = time.perf_counter() - inicio
+    if app_test.exception:
+        raise SystemExit(f"O app falhou: {app_test.exception[0].message}")
+
+    tempos = []
+    for _ in range(args.reruns):
+        inicio = time.perf_counter()
+        app_test.run()
+        tempos.append(time.perf_counter() - inicio)
+    bytes_rerun, externos = medir_pagina(app_test)
+
+    print(f"primeira execução: {primeira * 1000:9.1f} ms")
+    print(f"rerun (mediana):   {statistics.median(tempos) * 1000:9.1f} ms")
+    print(f"bytes por rerun:   {bytes_rerun:9d}")
+    print(f"fontes externas:   {externos:9d} referência(s)")
+
+
+if __name__ == "__main__":
+    main()
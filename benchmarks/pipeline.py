@@ -0,0 +1,374 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+# O benchmark mede a renderização; documentos servidos do cache em disco
+# mascarariam o custo real.
+os.environ.setdefault("ASPDOC_CACHE_RESULTADOS", "0")
+# As notas sintéticas também não entram no histórico de notas processadas.
+os.environ.setdefault("ASPDOC_HISTORICO", "0")
+
+from conversao_pdf import FORMATO_SAIDA_PADRAO, FORMATOS_SAIDA, EtapaPdf  # noqa: E402
+from processamento import (  # noqa: E402
+    DIRETORIO_TEMPLATES,
+    MODO_COMPRESSAO_PADRAO,
+    MODOS_COMPRESSAO,
+    ZipEmStreaming,
+    descartar_executor,
+    extrair_informacoes_xml,
+    gerar_documentos_em_memoria,
+    identificar_template,
+    iterar_notas,
+    nome_base_nota,
+    processar_lote,
+)
+from registro_templates import obter_registro  # noqa: E402
+
+
+TAMANHOS_PADRAO = (10, 100, 1000, 10000)
+ESTAGIOS = ("extrair", "identificar", "gerar", "pdf", "zip")
+
+SERVICOS = [
+    "Fornecimento de {quant} resmas de PAPEL A4",
+    "Prestação de serviços de digitalização, {quant} R$ por lote",
+    "Locação de equipamentos, {quant} R$ mensais",
+    "Serviço de organização documental ({quant} R$ caixas)",
+]
+
+
+def gerar_discriminacao(aleatorio, palavras):
+    servico = aleatorio.choice(SERVICOS).format(quant=aleatorio.randint(1, 500))
+    palavras = list(palavras)
+    aleatorio.shuffle(palavras)
+    complemento = " ".join(f"SECRETARIA DE {palavra}" if i else palavra for i, palavra in enumerate(palavras))
+    return f"{servico} - {complemento}. {aleatorio.randint(1, 500)} R$ conforme contrato."
+
+
+def gerar_xml_nfse(numero, data, competencia, valor, discriminacao, namespace=False):
+    xmlns = ' xmlns="http://www.abrasf.org.br/nfse.xsd"' if namespace else ""
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f"<CompNfse{xmlns}><Nfse versao=\"2.02\"><InfNfse Id=\"nfse{numero}\">"
+        f"<Numero>{numero}</Numero><CodigoVerificacao>{numero:08X}</CodigoVerificacao>"
+        f"<DataEmissao>{data}</DataEmissao>"
+        f"<DeclaracaoPrestacaoServico><InfDeclaracaoPrestacaoServico>"
+        f"<Rps><IdentificacaoRps><Numero>{numero + 50000}</Numero><Serie>1</Serie></IdentificacaoRps></Rps>"
+        f"<Competencia>{competencia}</Competencia>"
+        f"<Servico><Valores><ValorServicos>{valor}</ValorServicos><Aliquota>2.00</Aliquota></Valores>"
+        f"<Discriminacao>{escape(discriminacao)}</Discriminacao></Servico>"
+        f"</InfDeclaracaoPrestacaoServico></DeclaracaoPrestacaoServico>"
+        f"</InfNfse></Nfse></CompNfse>"
+    ).encode("utf-8")
+
+
+def gerar_notas(quantidade, semente=42):
+    aleatorio = random.Random(semente)
+    destinos = [
+        (cidade, template, palavras)
+        for cidade, palavras_chave in obter_registro().palavras_chave_por_cidade().items()
+        for template, palavras in palavras_chave.items()
+    ]
+    notas = []
+    for indice in range(quantidade):
+        cidade, template, palavras = destinos[indice % len(destinos)]
+        # Uma pequena parte das notas não casa com nenhum template, como
+        # acontece com XMLs enviados para a cidade errada.
+        if aleatorio.random() < 0.05:
+            palavras = ["SERVIÇO AVULSO"]
+        valor = Decimal(aleatorio.randint(5_000, 25_000_000)) / 100
+        data = f"2024-{aleatorio.randint(1, 12):02d}-{aleatorio.randint(1, 28):02d}"
+        competencia = f"{data[:7]}-01"
+        xml = gerar_xml_nfse(
+            1000 + indice,
+            data,
+            competencia,
+            valor,
+            gerar_discriminacao(aleatorio, palavras),
+            namespace=aleatorio.random() < 0.5,
+        )
+        notas.append((cidade, f"nfse_{1000 + indice}.xml", xml))
+    return notas
+
+
+def percentis(amostras):
+    if not amostras:
+        return {}
+    ordenadas = sorted(amostras)
+
+    def percentil(p):
+        return ordenadas[min(len(ordenadas) - 1, max(0, round(p / 100 * len(ordenadas)) - 1))]
+
+    return {
+        "p50_ms": percentil(50) * 1000,
+        "p90_ms": percentil(90) * 1000,
+        "p99_ms": percentil(99) * 1000,
+        "max_ms": ordenadas[-1] * 1000,
+        "media_ms": sum(ordenadas) / len(ordenadas) * 1000,
+        "total_s": sum(ordenadas),
+    }
+
+
+def pico_rss_mb(quem=resource.RUSAGE_SELF):
+    # ru_maxrss é em KB no Linux e em bytes no macOS.
+    pico = resource.getrusage(quem).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def resumo_pdf(etapa_pdf, duracao):
+    conversor = etapa_pdf.conversor
+    if etapa_pdf.formato == "docx":
+        return None
+    return {
+        "formato": etapa_pdf.formato,
+        "conversor": conversor.binario,
+        "workers": conversor.workers,
+        "tamanho_lote": etapa_pdf.tamanho_lote,
+        "documentos_convertidos": conversor.documentos_convertidos,
+        "documentos_com_erro": conversor.documentos_com_erro,
+        "tempo_conversao_s": conversor.tempo_conversao,
+        "pdf_por_s": conversor.documentos_convertidos / duracao if duracao else None,
+    }
+
+
+def executar_estagios(quantidade, semente, compressao=MODO_COMPRESSAO_PADRAO, formato=FORMATO_SAIDA_PADRAO):
+    notas = gerar_notas(quantidade, semente)
+    palavras_chave_por_cidade = obter_registro().palavras_chave_por_cidade()
+    tempos = {estagio: [] for estagio in ESTAGIOS}
+    zip_saida = ZipEmStreaming(modo=compressao)
+    etapa_pdf = EtapaPdf(formato)
+    documentos = 0
+
+    def gravar(prontos):
+        for pronto, documentos_nota in prontos:
+            zip_saida.adicionar(pronto, documentos_nota)
+
+    inicio = time.perf_counter()
+    for indice, (cidade, xml_file_name, xml) in enumerate(notas):
+        t0 = time.perf_counter()
+        dados = extrair_informacoes_xml(io.BytesIO(xml))
+        t1 = time.perf_counter()
+        tempos["extrair"].append(t1 - t0)
+        if dados is None:
+            gravar(etapa_pdf.adicionar(indice, []))
+            continue
+
+        template_folder = identificar_template(dados, palavras_chave_por_cidade[cidade])
+        t2 = time.perf_counter()
+        tempos["identificar"].append(t2 - t1)
+        if template_folder is None:
+            gravar(etapa_pdf.adicionar(indice, []))
+            continue
+
+        template_dir = os.path.join(DIRETORIO_TEMPLATES, cidade, template_folder)
+        gerados = gerar_documentos_em_memoria(template_dir, dados, nome_base_nota(dados, xml_file_name))
+        t3 = time.perf_counter()
+        tempos["gerar"].append(t3 - t2)
+
+        gravar(etapa_pdf.adicionar(indice, gerados))
+        documentos += len(gerados)
+        tempos["zip"].append(time.perf_counter() - t3)
+
+    gravar(etapa_pdf.finalizar())
+    t0 = time.perf_counter()
+    zip_saida.finalizar()
+    tamanho_zip = zip_saida.arquivo.tell()
+    zip_saida.fechar()
+    tempos["zip"].append(time.perf_counter() - t0)
+    tempos["pdf"] = list(etapa_pdf.tempos.values())
+    duracao = time.perf_counter() - inicio
+
+    return {
+        "modo": "estagios",
+        "notas": quantidade,
+        "documentos": documentos,
+        "documentos_zip": zip_saida.total_documentos,
+        "duracao_s": duracao,
+        "notas_por_s": quantidade / duracao if duracao else None,
+        "tamanho_zip_bytes": tamanho_zip,
+        "compressao": zip_saida.resumo_compressao(),
+        "pdf": resumo_pdf(etapa_pdf, duracao),
+        "estagios": {estagio: percentis(amostras) for estagio, amostras in tempos.items()},
+        "pico_rss_mb": pico_rss_mb(),
+    }
+
+
+def executar_lote(quantidade, semente, workers, compressao=MODO_COMPRESSAO_PADRAO, formato=FORMATO_SAIDA_PADRAO):
+    notas = gerar_notas(quantidade, semente)
+    etapa_pdf = EtapaPdf(formato)
+    documentos = 0
+
+    inicio = time.perf_counter()
+    for cidade, palavras_chave in obter_registro().palavras_chave_por_cidade().items():
+        xmls = [(xml_file_name, xml) for cidade_nota, xml_file_name, xml in notas if cidade_nota == cidade]
+        templates_base_dir = os.path.join(DIRETORIO_TEMPLATES, cidade)
+        zip_saida = ZipEmStreaming(modo=compressao)
+        for indice, resultado in processar_lote(iterar_notas(xmls), templates_base_dir, palavras_chave, workers):
+            documentos += len(resultado["documentos"])
+            for pronto, documentos_nota in etapa_pdf.adicionar(indice, resultado["documentos"]):
+                zip_saida.adicionar(pronto, documentos_nota)
+        for pronto, documentos_nota in etapa_pdf.finalizar():
+            zip_saida.adicionar(pronto, documentos_nota)
+        zip_saida.finalizar()
+        zip_saida.fechar()
+    duracao = time.perf_counter() - inicio
+    # Encerra o pool para que o pico de memória dos workers entre em
+    # RUSAGE_CHILDREN.
+    descartar_executor(esperar=True)
+
+    return {
+        "modo": "lote",
+        "workers": workers,
+        "notas": quantidade,
+        "documentos": documentos,
+        "duracao_s": duracao,
+        "notas_por_s": quantidade / duracao if duracao else None,
+        "pdf": resumo_pdf(etapa_pdf, duracao),
+        "pico_rss_mb": pico_rss_mb(),
+        "pico_rss_workers_mb": pico_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def executar_cenario(
+    modo, quantidade, semente, workers, compressao=MODO_COMPRESSAO_PADRAO, formato=FORMATO_SAIDA_PADRAO
+):
+    if modo == "lote":
+        return executar_lote(quantidade, semente, workers, compressao, formato)
+    return executar_estagios(quantidade, semente, compressao, formato)
+
+
+def executar_cenario_isolado(
+    modo, quantidade, semente, workers, compressao=MODO_COMPRESSAO_PADRAO, formato=FORMATO_SAIDA_PADRAO
+):
+    # Cada cenário roda num interpretador novo para que o pico de RSS e os
+    # caches de templates não vazem de um tamanho para o outro.
+    processo = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.pipeline",
+            "--cenario",
+            modo,
+            "--tamanhos",
+            str(quantidade),
+            "--semente",
+            str(semente),
+            "--workers",
+            str(workers),
+            "--compressao",
+            compressao,
+            "--formato",
+            formato,
+        ],
+        cwd=DIRETORIO_TEMPLATES,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    return json.loads(processo.stdout.strip().splitlines()[-1])
+
+
+def revisao_git():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=DIRETORIO_TEMPLATES,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def imprimir_resumo(resultado):
+    linha = f"{resultado['modo']:>9} {resultado['notas']:>6} notas  {resultado['notas_por_s']:8.1f} notas/s  "
+    linha += f"pico RSS {resultado['pico_rss_mb']:7.1f} MB"
+    print(linha, file=sys.stderr)
+    if resultado.get("pdf"):
+        pdf = resultado["pdf"]
+        if pdf["conversor"] is None:
+            print(f"{'':>16}pdf: conversor não encontrado, documentos mantidos em DOCX", file=sys.stderr)
+        else:
+            print(
+                f"{'':>16}pdf: {pdf['documentos_convertidos']} convertido(s), {pdf['pdf_por_s']:.1f} PDF/s, "
+                f"{pdf['documentos_com_erro']} com erro",
+                file=sys.stderr,
+            )
+    for estagio, estatisticas in resultado.get("estagios", {}).items():
+        if estatisticas:
+            print(
+                f"{'':>16}{estagio:<12} p50 {estatisticas['p50_ms']:8.2f} ms  "
+                f"p90 {estatisticas['p90_ms']:8.2f} ms  p99 {estatisticas['p99_ms']:8.2f} ms",
+                file=sys.stderr,
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do fluxo XML -> DOCX -> ZIP com NFS-e sintéticas.")
+    parser.add_argument(
+        "--tamanhos",
+        default=",".join(str(t) for t in TAMANHOS_PADRAO),
+        help="Quantidades de notas separadas por vírgula (padrão: 10,100,1000,10000).",
+    )
+    parser.add_argument("--modo", choices=("estagios", "lote", "ambos"), default="estagios")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processos do modo lote.")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--compressao", choices=sorted(MODOS_COMPRESSAO), default=MODO_COMPRESSAO_PADRAO)
+    parser.add_argument(
+        "--formato",
+        choices=FORMATOS_SAIDA,
+        default=FORMATO_SAIDA_PADRAO,
+        help="pdf ou ambos medem também a conversão para PDF com o LibreOffice.",
+    )
+    parser.add_argument("--saida", help="Arquivo JSON de saída (padrão: stdout).")
+    parser.add_argument("--cenario", choices=("estagios", "lote"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    tamanhos = [int(t) for t in args.tamanhos.split(",") if t.strip()]
+    if args.cenario:
+        resultado = executar_cenario(
+            args.cenario, tamanhos[0], args.semente, args.workers, args.compressao, args.formato
+        )
+        print(json.dumps(resultado))
+        return
+
+    modos = ("estagios", "lote") if args.modo == "ambos" else (args.modo,)
+
+    resultados = []
+    for modo in modos:
+        for quantidade in tamanhos:
+            resultado = executar_cenario_isolado(
+                modo, quantidade, args.semente, args.workers, args.compressao, args.formato
+            )
+            imprimir_resumo(resultado)
+            resultados.append(resultado)
+
+    relatorio = {
+        "revisao": revisao_git(),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "semente": args.semente,
+        "compressao": args.compressao,
+        "formato": args.formato,
+        "resultados": resultados,
+    }
+    texto = json.dumps(relatorio, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
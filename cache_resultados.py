@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+VERSAO_CACHE_RESULTADOS = "1"
+
+CACHE_RESULTADOS_ATIVO = os.environ.get("ASPDOC_CACHE_RESULTADOS", "1") != "0"
+DIRETORIO_CACHE_RESULTADOS = os.environ.get("ASPDOC_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "aspdoc", "documentos"
+)
+TAMANHO_MAXIMO_CACHE_RESULTADOS = int(os.environ.get("ASPDOC_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+_bytes_desde_limpeza = 0
+_limpeza_lock = threading.Lock()
+
+
+def chave_resultado(dados, template_hash):
+    # O documento gerado depende só dos dados da nota e dos bytes do
+    # template; a cidade e a pasta da secretaria já estão no hash do template.
+    h = hashlib.sha256()
+    h.update(VERSAO_CACHE_RESULTADOS.encode("utf-8"))
+    h.update(b"\0")
+    h.update(template_hash.encode("utf-8"))
+    h.update(b"\0")
+    h.update(json.dumps(dados, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _caminho_resultado(chave):
+    return os.path.join(DIRETORIO_CACHE_RESULTADOS, chave[:2], f"{chave}.docx")
+
+
+def obter_resultado(chave):
+    if not CACHE_RESULTADOS_ATIVO:
+        return None
+
+    caminho = _caminho_resultado(chave)
+    try:
+        with open(caminho, "rb") as arquivo:
+            conteudo = arquivo.read()
+    except OSError:
+        return None
+
+    # A data de modificação marca o último uso para a remoção LRU.
+    try:
+        os.utime(caminho)
+    except OSError:
+        pass
+    return conteudo
+
+
+def guardar_resultado(chave, conteudo):
+    global _bytes_desde_limpeza
+    if not CACHE_RESULTADOS_ATIVO:
+        return
+
+    caminho = _caminho_resultado(chave)
+    diretorio = os.path.dirname(caminho)
+    try:
+        os.makedirs(diretorio, exist_ok=True)
+        fd, temporario = tempfile.mkstemp(dir=diretorio, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as arquivo:
+                arquivo.write(conteudo)
+            os.replace(temporario, caminho)
+        except BaseException:
+            os.remove(temporario)
+            raise
+    except OSError as e:
+        print(f"Aviso: não foi possível gravar no cache de documentos: {e}")
+        return
+
+    with _limpeza_lock:
+        _bytes_desde_limpeza += len(conteudo)
+        limpar = _bytes_desde_limpeza > TAMANHO_MAXIMO_CACHE_RESULTADOS // 10
+        if limpar:
+            _bytes_desde_limpeza = 0
+    if limpar:
+        limpar_cache_resultados()
+
+
+def limpar_cache_resultados(tamanho_maximo=None):
+    if tamanho_maximo is None:
+        tamanho_maximo = TAMANHO_MAXIMO_CACHE_RESULTADOS
+
+    arquivos = []
+    total = 0
+    for raiz, _, nomes in os.walk(DIRETORIO_CACHE_RESULTADOS):
+        for nome in nomes:
+            if not nome.endswith(".docx"):
+                continue
+            caminho = os.path.join(raiz, nome)
+            try:
+                stat = os.stat(caminho)
+            except OSError:
+                continue
+            arquivos.append((stat.st_mtime, stat.st_size, caminho))
+            total += stat.st_size
+
+    if total <= tamanho_maximo:
+        return
+
+    # Remove os menos usados até sobrar uma folga de 10%, para não varrer o
+    # diretório de novo a cada documento gravado.
+    alvo = tamanho_maximo * 9 // 10
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= alvo:
+            break
+        try:
+            os.remove(caminho)
+        except OSError:
+            continue
+        total -= tamanho
@@ -0,0 +1,277 @@
+import copy
+import hashlib
+import io
+import os
+import posixpath
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+
+from docxtpl import DocxTemplate
+from jinja2 import Environment
+from lxml import etree
+
+from metricas import medir
+
+
+TAMANHO_MAXIMO_CACHE_TEMPLATES = 64
+
+PADRAO_TAG_JINJA = re.compile(r"\{[{%#]")
+PADRAO_TAG_XML = re.compile(r"<[^>]+>")
+
+PADRAO_VARIAVEL = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+PADRAO_ROTULO_TOTAL = re.compile(r"\bTOTAL\b", re.IGNORECASE)
+
+NAMESPACE_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+TIPO_DOCUMENTO_PRINCIPAL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+# Partes que o próprio docxtpl renderiza, além do documento principal.
+TIPOS_PARTES_RENDERIZADAS = ("/header", "/footer", "/footnotes")
+
+
+class AmbienteJinjaCompilado(Environment):
+    # O docxtpl chama from_string para cada parte (corpo, cabeçalhos, rodapés)
+    # a cada renderização. Para o mesmo template o XML de origem é sempre o
+    # mesmo, então guardamos o Jinja já compilado por texto de origem.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._compilados = {}
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+
+        template = self._compilados.get(source)
+        if template is None:
+            template = super().from_string(source)
+            self._compilados[source] = template
+        return template
+
+
+def _ler_relacionamentos(pacote, nome_parte):
+    pasta, nome = posixpath.split(nome_parte)
+    caminho_rels = posixpath.join(pasta, "_rels", f"{nome}.rels")
+    if caminho_rels not in pacote.namelist():
+        return []
+    relacionamentos = []
+    for rel in etree.fromstring(pacote.read(caminho_rels)):
+        if rel.get("TargetMode") == "External":
+            continue
+        alvo = posixpath.normpath(posixpath.join(pasta, rel.get("Target"))).lstrip("/")
+        relacionamentos.append((rel.get("Type"), alvo))
+    return relacionamentos
+
+
+def _copiar_info(info):
+    # writestr altera o ZipInfo recebido; cada gravação usa uma cópia.
+    copia = zipfile.ZipInfo(info.filename, info.date_time)
+    copia.compress_type = zipfile.ZIP_DEFLATED
+    copia.external_attr = info.external_attr
+    return copia
+
+
+def separar_partes(conteudo):
+    # Divide o .docx em partes com tags Jinja, que precisam ser renderizadas a
+    # cada nota, e o resto (estilos, imagens, fontes, objetos embutidos), que
+    # vai uma única vez para um ZIP base e é copiado como está a cada nota.
+    # Devolve None quando o template tem tags em partes que só o fluxo
+    # completo do docxtpl sabe renderizar (ex.: propriedades do documento).
+    with zipfile.ZipFile(io.BytesIO(conteudo)) as pacote:
+        principal = next(
+            (alvo for tipo, alvo in _ler_relacionamentos(pacote, "") if tipo == TIPO_DOCUMENTO_PRINCIPAL),
+            None,
+        )
+        if principal is None:
+            return None
+        renderizadas = {principal} | {
+            alvo for tipo, alvo in _ler_relacionamentos(pacote, principal) if tipo.endswith(TIPOS_PARTES_RENDERIZADAS)
+        }
+
+        partes = []
+        base = io.BytesIO()
+        with zipfile.ZipFile(base, "w", zipfile.ZIP_DEFLATED) as estatico:
+            for info in pacote.infolist():
+                dados = pacote.read(info)
+                tem_tags = info.filename.endswith(".xml") and PADRAO_TAG_JINJA.search(
+                    PADRAO_TAG_XML.sub("", dados.decode("utf-8", errors="ignore"))
+                )
+                if not tem_tags:
+                    estatico.writestr(_copiar_info(info), dados)
+                    continue
+                if info.filename not in renderizadas:
+                    return None
+                fonte = DocxTemplate(None).patch_xml(dados.decode("utf-8"))
+                partes.append((info, fonte, info.filename == principal))
+    return partes, base.getvalue()
+
+
+def _linha_com_texto(linha, texto):
+    nova = copy.deepcopy(linha)
+    textos = list(nova.iter(f"{NAMESPACE_W}t"))
+    for elemento in textos:
+        elemento.text = ""
+    textos[0].text = texto
+    return nova
+
+
+def _linha_total(linha):
+    if not any(campo == "valor" for campo in PADRAO_VARIAVEL.findall("".join(linha.itertext()))):
+        return None
+    total = copy.deepcopy(linha)
+    for elemento in total.iter(f"{NAMESPACE_W}t"):
+        if elemento.text:
+            elemento.text = PADRAO_VARIAVEL.sub(
+                lambda m: "{{ total }}" if m.group(1) == "valor" else "", elemento.text
+            )
+    primeira_celula = total.find(f"{NAMESPACE_W}tc")
+    textos = list(primeira_celula.iter(f"{NAMESPACE_W}t")) if primeira_celula is not None else []
+    if textos and not "".join(elemento.text or "" for elemento in textos).strip():
+        textos[0].text = "TOTAL"
+    return total
+
+
+def _eh_linha_total(linha):
+    return PADRAO_ROTULO_TOTAL.search("".join(linha.itertext())) is not None
+
+
+def derivar_fonte_consolidada(fonte):
+    # Transforma o XML (já passado pelo patch_xml) do documento de uma nota
+    # no documento do lote: a primeira linha de cada tabela com campos da nota
+    # passa a se repetir para cada item de `notas` e, se a tabela ainda não
+    # tem uma, ganha uma linha de TOTAL. As demais linhas (como "QUANTIDADE
+    # TOTAL") e o resto do texto recebem os valores agregados do lote.
+    raiz = etree.fromstring(fonte.encode("utf-8"))
+    linhas = []
+    for tabela in raiz.iter(f"{NAMESPACE_W}tbl"):
+        linhas_tabela = [linha for linha in tabela.findall(f"{NAMESPACE_W}tr") if linha.find(f".//{NAMESPACE_W}tr") is None]
+        com_campos = [linha for linha in linhas_tabela if PADRAO_VARIAVEL.search("".join(linha.itertext()))]
+        if com_campos and not _eh_linha_total(com_campos[0]):
+            linhas.append((com_campos[0], any(_eh_linha_total(linha) for linha in linhas_tabela)))
+    for linha, tem_total in linhas:
+        total = None if tem_total else _linha_total(linha)
+        for elemento in linha.iter(f"{NAMESPACE_W}t"):
+            if elemento.text:
+                elemento.text = PADRAO_VARIAVEL.sub(r"{{ nota.\1 }}", elemento.text)
+        linha.addprevious(_linha_com_texto(linha, "{%tr for nota in notas %}"))
+        fechamento = _linha_com_texto(linha, "{%tr endfor %}")
+        linha.addnext(fechamento)
+        if total is not None:
+            fechamento.addnext(total)
+    return DocxTemplate(None).patch_xml(etree.tostring(raiz, encoding="unicode"))
+
+
+class TemplateEmCache:
+    def __init__(self, caminho, assinatura, conteudo):
+        self.caminho = caminho
+        self.assinatura = assinatura
+        self.conteudo = conteudo
+        self.hash = hashlib.sha256(conteudo).hexdigest()
+        self.ambiente = AmbienteJinjaCompilado()
+        try:
+            separado = separar_partes(conteudo)
+        except Exception as e:
+            print(f"Template {caminho} será renderizado pelo fluxo completo: {str(e)}")
+            separado = None
+        self.partes, self.base = separado if separado is not None else (None, None)
+        self._partes_consolidadas = None
+        self._consolidado_lock = threading.Lock()
+
+    def partes_consolidadas(self):
+        # Derivadas só quando o modo consolidado é usado pela primeira vez.
+        if self.partes is None:
+            return None
+        with self._consolidado_lock:
+            if self._partes_consolidadas is None:
+                try:
+                    self._partes_consolidadas = [
+                        (info, derivar_fonte_consolidada(fonte) if principal else fonte, principal)
+                        for info, fonte, principal in self.partes
+                    ]
+                except Exception as e:
+                    print(f"Template {self.caminho} sem versão consolidada: {str(e)}")
+                    self._partes_consolidadas = []
+            return self._partes_consolidadas or None
+
+    def _renderizar_partes(self, dados, partes=None):
+        # Mesmo tratamento que o docxtpl dá a cada parte, mas direto sobre o
+        # XML do ZIP: sem montar o documento inteiro no python-docx.
+        auxiliar = DocxTemplate(None)
+        auxiliar.docx_ids_index = 1000
+        renderizadas = []
+        for info, fonte, principal in partes or self.partes:
+            xml = auxiliar.render_xml_part(fonte, None, dados, self.ambiente)
+            arvore = auxiliar.fix_tables(xml.encode("utf-8"))
+            if principal:
+                auxiliar.fix_docpr_ids(arvore)
+            renderizadas.append(
+                (info, etree.tostring(arvore, xml_declaration=True, encoding="UTF-8", standalone=True))
+            )
+        return renderizadas
+
+    def aquecer(self, dados):
+        # Renderiza uma vez sem gravar: deixa o Jinja de todas as partes
+        # compilado no ambiente antes da primeira nota real.
+        if self.partes is not None:
+            self._renderizar_partes(dados)
+        else:
+            DocxTemplate(io.BytesIO(self.conteudo)).render(dados, self.ambiente)
+
+    def renderizar(self, dados, tempos=None, consolidado=False):
+        partes = self.partes_consolidadas() if consolidado else self.partes
+        if partes is None:
+            # Sem versão consolidada o template recebe só os valores agregados.
+            return self._renderizar_completo(dados, tempos)
+
+        with medir(tempos, "renderizacao"):
+            renderizadas = self._renderizar_partes(dados, partes)
+        with medir(tempos, "gravacao"):
+            # O ZIP base já tem as partes estáticas comprimidas; só as partes
+            # renderizadas são comprimidas de novo.
+            destino = io.BytesIO(self.base)
+            with zipfile.ZipFile(destino, "a", zipfile.ZIP_DEFLATED) as pacote:
+                for info, xml in renderizadas:
+                    pacote.writestr(_copiar_info(info), xml)
+            return destino.getvalue()
+
+    def _renderizar_completo(self, dados, tempos=None):
+        with medir(tempos, "renderizacao"):
+            doc = DocxTemplate(io.BytesIO(self.conteudo))
+            doc.render(dados, self.ambiente)
+        with medir(tempos, "gravacao"), io.BytesIO() as destino:
+            doc.save(destino)
+            return destino.getvalue()
+
+
+_cache_templates = OrderedDict()
+_cache_templates_lock = threading.Lock()
+
+
+def _assinatura_arquivo(caminho):
+    stat = os.stat(caminho)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def obter_template(template_path):
+    caminho = os.path.abspath(template_path)
+    assinatura = _assinatura_arquivo(caminho)
+
+    with _cache_templates_lock:
+        entrada = _cache_templates.get(caminho)
+        if entrada is not None and entrada.assinatura == assinatura:
+            _cache_templates.move_to_end(caminho)
+            return entrada
+
+    with open(caminho, "rb") as arquivo:
+        conteudo = arquivo.read()
+    # O arquivo pode ter mudado entre o stat e a leitura; a assinatura
+    # registrada é a do conteúdo efetivamente lido.
+    entrada = TemplateEmCache(caminho, _assinatura_arquivo(caminho), conteudo)
+
+    with _cache_templates_lock:
+        _cache_templates[caminho] = entrada
+        _cache_templates.move_to_end(caminho)
+        while len(_cache_templates) > TAMANHO_MAXIMO_CACHE_TEMPLATES:
+            _cache_templates.popitem(last=False)
+    return entrada
+
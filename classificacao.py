@@ -0,0 +1,46 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+
+def normalizar_texto(texto):
+    decomposto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in decomposto if not unicodedata.combining(c)).upper()
+
+
+class ClassificadorTemplates:
+    def __init__(self, palavras_chave):
+        self.templates = list(palavras_chave)
+        self._exigidas = {
+            template: frozenset(normalizar_texto(palavra) for palavra in palavras)
+            for template, palavras in palavras_chave.items()
+        }
+
+        termos = sorted({termo for exigidas in self._exigidas.values() for termo in exigidas}, key=len, reverse=True)
+        # O lookahead encontra, em cada posição, a palavra-chave mais longa que
+        # começa ali; as mais curtas que também começam ali são substrings
+        # dela e entram via `_contidos`, então uma única varredura basta.
+        self._padrao = re.compile("(?=(" + "|".join(re.escape(termo) for termo in termos) + "))") if termos else None
+        self._contidos = {termo: frozenset(t for t in termos if t in termo) for termo in termos}
+
+    def termos_encontrados(self, discriminacao):
+        if self._padrao is None:
+            return frozenset()
+        encontrados = set()
+        for match in self._padrao.finditer(normalizar_texto(discriminacao)):
+            encontrados |= self._contidos[match.group(1)]
+        return encontrados
+
+    def classificar(self, discriminacao):
+        encontrados = self.termos_encontrados(discriminacao)
+        return [template for template in self.templates if self._exigidas[template] <= encontrados]
+
+
+@lru_cache(maxsize=32)
+def _classificador_em_cache(chave):
+    return ClassificadorTemplates({template: list(palavras) for template, palavras in chave})
+
+
+def obter_classificador(palavras_chave):
+    chave = tuple((template, tuple(palavras)) for template, palavras in palavras_chave.items())
+    return _classificador_em_cache(chave)
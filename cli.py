@@ -0,0 +1,157 @@
+import argparse
+import glob
+import os
+import sys
+
+from conversao_pdf import FORMATO_SAIDA_PADRAO, FORMATOS_SAIDA
+from pacotes_xml import eh_pacote
+from processamento import (
+    DIRETORIO_TEMPLATES,
+    MODO_COMPRESSAO_PADRAO,
+    MODOS_COMPRESSAO,
+    gravar_documentos_lote,
+    listar_xmls,
+    numero_workers_padrao,
+    processar_todos_xmls,
+)
+from registro_templates import carregar_registro
+
+
+def coletar_xmls(entradas):
+    xmls = []
+    vistos = set()
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            encontrados = listar_xmls(entrada)
+        else:
+            encontrados = [
+                (os.path.basename(caminho), caminho)
+                for caminho in sorted(glob.glob(entrada, recursive=True))
+                if (caminho.endswith(".xml") or eh_pacote(caminho)) and os.path.isfile(caminho)
+            ]
+
+        for xml_file, xml_path in encontrados:
+            caminho = os.path.abspath(xml_path)
+            if caminho not in vistos:
+                vistos.add(caminho)
+                xmls.append((xml_file, caminho))
+    return xmls
+
+
+def criar_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m cli",
+        description="Gera as planilhas e relatórios DOCX a partir de XMLs de NFS-e, sem a interface Streamlit.",
+    )
+    parser.add_argument(
+        "entradas",
+        nargs="+",
+        help="Diretórios com XMLs ou pacotes .zip/.tar.gz, ou padrões glob (ex.: 'xmls/**/*.xml').",
+    )
+    parser.add_argument(
+        "--cidade",
+        required=True,
+        type=str.upper,
+        help="Município cujos templates e palavras-chave serão usados (uma pasta com manifestos em --templates).",
+    )
+    parser.add_argument(
+        "--saida",
+        required=True,
+        help="Diretório de saída ou caminho terminado em .zip.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=numero_workers_padrao(),
+        help="Quantidade de processos em paralelo (padrão: número de CPUs).",
+    )
+    parser.add_argument(
+        "--compressao",
+        choices=sorted(MODOS_COMPRESSAO),
+        default=MODO_COMPRESSAO_PADRAO,
+        help="Compressão do ZIP de saída: armazenar (padrão), rapida ou maxima.",
+    )
+    parser.add_argument(
+        "--consolidado",
+        action="store_true",
+        help="Gera uma Planilha e um Relatorio por secretaria com todas as notas do lote, em vez de um par por nota.",
+    )
+    parser.add_argument(
+        "--formato",
+        choices=FORMATOS_SAIDA,
+        default=FORMATO_SAIDA_PADRAO,
+        help="Formato dos documentos: docx (padrão), pdf ou ambos. PDF exige o LibreOffice instalado.",
+    )
+    parser.add_argument(
+        "--pular-processadas",
+        action="store_true",
+        help="Não gera de novo notas com o mesmo número e conteúdo já registradas no histórico.",
+    )
+    parser.add_argument(
+        "--templates",
+        default=DIRETORIO_TEMPLATES,
+        help="Diretório que contém as pastas de templates de cada cidade.",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = criar_parser().parse_args(argv)
+    if args.jobs < 1:
+        print("Erro: --jobs deve ser maior ou igual a 1.", file=sys.stderr)
+        return 2
+
+    registro = carregar_registro(args.templates)
+    for erro in registro.erros:
+        print(f"Aviso: {erro}", file=sys.stderr)
+    cidade = registro.cidades.get(args.cidade)
+    if cidade is None:
+        disponiveis = ", ".join(registro.nomes) or "nenhum"
+        print(f"Erro: município '{args.cidade}' não encontrado (disponíveis: {disponiveis}).", file=sys.stderr)
+        return 2
+
+    templates_base_dir = cidade.diretorio
+    palavras_chave = cidade.palavras_chave
+
+    if len(args.entradas) == 1 and os.path.isdir(args.entradas[0]):
+        gerados = processar_todos_xmls(
+            args.entradas[0],
+            templates_base_dir,
+            palavras_chave,
+            args.saida,
+            args.jobs,
+            args.compressao,
+            args.consolidado,
+            args.formato,
+            args.pular_processadas,
+        )
+    else:
+        xmls = coletar_xmls(args.entradas)
+        if not xmls:
+            print("Nenhum XML encontrado nas entradas informadas.", file=sys.stderr)
+            return 1
+        gerados = gravar_documentos_lote(
+            xmls,
+            templates_base_dir,
+            palavras_chave,
+            args.saida,
+            args.jobs,
+            args.compressao,
+            args.consolidado,
+            args.formato,
+            args.pular_processadas,
+        )
+
+    if not gerados:
+        if args.pular_processadas:
+            print("Nenhum documento foi gerado; as notas podem já estar no histórico.", file=sys.stderr)
+            return 1
+        print("Nenhum documento foi gerado. Verifique os XMLs e as palavras-chave.", file=sys.stderr)
+        return 1
+
+    print(f"{len(gerados)} documento(s) gerado(s) em {args.saida}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+from metricas import descrever_erro
+
+
+FORMATOS_SAIDA = ("docx", "pdf", "ambos")
+FORMATO_SAIDA_PADRAO = "docx"
+
+BINARIOS_CONVERSOR = ("soffice", "libreoffice")
+
+# Documentos por chamada ao LibreOffice: o processo sobe uma vez por lote e
+# não uma vez por arquivo.
+TAMANHO_LOTE_PDF = int(os.environ.get("ASPDOC_PDF_LOTE", "16"))
+TIMEOUT_POR_DOCUMENTO = 30
+TIMEOUT_INICIALIZACAO = 120
+
+
+def localizar_conversor():
+    configurado = os.environ.get("ASPDOC_SOFFICE")
+    for candidato in (configurado,) if configurado else BINARIOS_CONVERSOR:
+        caminho = shutil.which(candidato)
+        if caminho:
+            return caminho
+    return None
+
+
+def numero_conversores_padrao():
+    return int(os.environ.get("ASPDOC_PDF_WORKERS", "0")) or min(2, os.cpu_count() or 1)
+
+
+def nome_pdf(nome_arquivo):
+    return f"{os.path.splitext(nome_arquivo)[0]}.pdf"
+
+
+class ConversorPdf:
+    # Conversores headless do LibreOffice que vivem enquanto o processo vive.
+    # Cada worker tem um perfil de usuário próprio, criado uma única vez e
+    # reaproveitado em todas as conversões: montar o perfil é a maior parte do
+    # custo de abrir o soffice, e dois soffice não podem usar o mesmo perfil ao
+    # mesmo tempo.
+    def __init__(self, binario=None, workers=None):
+        self.binario = binario or localizar_conversor()
+        self.workers = workers or numero_conversores_padrao()
+        self.documentos_convertidos = 0
+        self.documentos_com_erro = 0
+        self.tempo_conversao = 0.0
+        self._raiz = None
+        self._perfis = queue.Queue()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def disponivel(self):
+        return self.binario is not None
+
+    def _iniciar(self):
+        with self._lock:
+            if self._executor is None:
+                self._raiz = tempfile.mkdtemp(prefix="aspdoc-pdf-")
+                for numero in range(self.workers):
+                    self._perfis.put(Path(self._raiz, f"perfil_{numero}").as_uri())
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aspdoc-pdf")
+            return self._executor
+
+    def _executar(self, perfil, argumentos, timeout):
+        return subprocess.run(
+            [
+                self.binario,
+                f"-env:UserInstallation={perfil}",
+                "--headless",
+                "--invisible",
+                "--nologo",
+                "--nodefault",
+                "--norestore",
+                "--nolockcheck",
+                *argumentos,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=timeout,
+            check=False,
+        )
+
+    def _preparar_perfil(self):
+        perfil = self._perfis.get()
+        try:
+            self._executar(perfil, ["--terminate_after_init"], TIMEOUT_INICIALIZACAO)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Erro ao iniciar o conversor de PDF: {str(e)}")
+        finally:
+            self._perfis.put(perfil)
+
+    def aquecer(self):
+        # Cria os perfis em segundo plano; o primeiro lote já encontra os
+        # conversores prontos.
+        if not self.disponivel:
+            return []
+        executor = self._iniciar()
+        return [executor.submit(self._preparar_perfil) for _ in range(self.workers)]
+
+    def _converter_lote(self, documentos):
+        inicio = time.perf_counter()
+        perfil = self._perfis.get()
+        try:
+            with tempfile.TemporaryDirectory(dir=self._raiz) as temp_dir:
+                entrada = os.path.join(temp_dir, "docx")
+                saida = os.path.join(temp_dir, "pdf")
+                os.makedirs(entrada)
+                # Nomes sequenciais: documentos de notas diferentes podem ter
+                # o mesmo nome dentro do lote.
+                caminhos = []
+                for numero, (_, conteudo) in enumerate(documentos):
+                    caminho = os.path.join(entrada, f"{numero:05d}.docx")
+                    with open(caminho, "wb") as f:
+                        f.write(conteudo)
+                    caminhos.append(caminho)
+
+                try:
+                    processo = self._executar(
+                        perfil,
+                        ["--convert-to", "pdf", "--outdir", saida, *caminhos],
+                        TIMEOUT_POR_DOCUMENTO * len(documentos),
+                    )
+                    if processo.returncode != 0:
+                        erro = processo.stderr.decode("utf-8", errors="replace")[-500:]
+                        print(f"Conversor de PDF terminou com código {processo.returncode}: {erro}")
+                except (OSError, subprocess.SubprocessError) as e:
+                    print(f"Erro ao converter documentos para PDF: {str(e)}")
+
+                convertidos = []
+                for numero in range(len(documentos)):
+                    caminho = os.path.join(saida, f"{numero:05d}.pdf")
+                    if os.path.exists(caminho):
+                        with open(caminho, "rb") as f:
+                            convertidos.append(f.read())
+                    else:
+                        convertidos.append(None)
+        finally:
+            self._perfis.put(perfil)
+
+        with self._lock:
+            self.documentos_convertidos += sum(1 for pdf in convertidos if pdf is not None)
+            self.documentos_com_erro += sum(1 for pdf in convertidos if pdf is None)
+            self.tempo_conversao += time.perf_counter() - inicio
+        return convertidos, time.perf_counter() - inicio
+
+    def converter(self, documentos):
+        # Devolve um futuro com a lista de PDFs na ordem de `documentos` (None
+        # para o que não pôde ser convertido) e a duração da chamada.
+        return self._iniciar().submit(self._converter_lote, list(documentos))
+
+    def fechar(self):
+        with self._lock:
+            executor, raiz = self._executor, self._raiz
+            self._executor = None
+            self._raiz = None
+            self._perfis = queue.Queue()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+            shutil.rmtree(raiz, ignore_errors=True)
+
+
+_conversor = None
+_conversor_lock = threading.Lock()
+
+
+def obter_conversor_pdf():
+    global _conversor
+    with _conversor_lock:
+        if _conversor is None:
+            _conversor = ConversorPdf()
+        return _conversor
+
+
+class EtapaPdf:
+    # Etapa opcional entre a renderização e o ZIP. Os documentos de várias
+    # notas são juntados em lotes de `tamanho_lote` e convertidos nos workers
+    # do conversor enquanto o pool continua renderizando; cada nota sai com
+    # seu índice original, para o ZipEmStreaming gravar na ordem do lote.
+    def __init__(self, formato=FORMATO_SAIDA_PADRAO, conversor=None, tamanho_lote=TAMANHO_LOTE_PDF):
+        self.formato = formato
+        self.conversor = conversor or obter_conversor_pdf()
+        self.tamanho_lote = max(tamanho_lote, 1)
+        self.avisos = []
+        self.erros = []
+        self.tempos = {}
+        self.ativa = formato != "docx" and self.conversor.disponivel
+        if formato != "docx" and not self.conversor.disponivel:
+            self.avisos.append("LibreOffice não encontrado no servidor; os documentos foram mantidos em DOCX.")
+        self._acumulados = []
+        self._futuros = []
+        # Lotes em conversão ao mesmo tempo; acima disso quem entrega os
+        # documentos espera, para que a memória não cresça sem limite.
+        self._limite_pendentes = self.conversor.workers * 2
+
+    def _montar(self, documentos, pdfs):
+        saida = []
+        for (nome_arquivo, conteudo), pdf in zip(documentos, pdfs):
+            if pdf is None:
+                self.avisos.append(f"Não foi possível converter '{nome_arquivo}' para PDF; mantido em DOCX.")
+                self.erros.append(
+                    descrever_erro(None, "pdf", "o LibreOffice não gerou o PDF", documento=nome_arquivo)
+                )
+                saida.append((nome_arquivo, conteudo))
+                continue
+            if self.formato == "ambos":
+                saida.append((nome_arquivo, conteudo))
+            saida.append((nome_pdf(nome_arquivo), pdf))
+        return saida
+
+    def _enviar(self):
+        if self._acumulados:
+            documentos = [documento for _, docs in self._acumulados for documento in docs]
+            self._futuros.append((self._acumulados, self.conversor.converter(documentos)))
+            self._acumulados = []
+
+    def _coletar(self, bloquear=False):
+        prontos = []
+        while self._futuros and (
+            bloquear or self._futuros[0][1].done() or len(self._futuros) > self._limite_pendentes
+        ):
+            notas, futuro = self._futuros.pop(0)
+            pdfs, duracao = futuro.result()
+            total = sum(len(docs) for _, docs in notas) or 1
+            for indice, docs in notas:
+                self.tempos[indice] = duracao * len(docs) / total
+                prontos.append((indice, self._montar(docs, pdfs[: len(docs)])))
+                pdfs = pdfs[len(docs):]
+        return prontos
+
+    def adicionar(self, indice, documentos):
+        # Devolve as notas (índice, documentos) que já podem ir para o ZIP.
+        if not self.ativa or not documentos:
+            return [(indice, documentos)] + self._coletar()
+        self._acumulados.append((indice, documentos))
+        if sum(len(docs) for _, docs in self._acumulados) >= self.tamanho_lote:
+            self._enviar()
+        return self._coletar()
+
+    def finalizar(self):
+        self._enviar()
+        return self._coletar(bloquear=True)
+
+    def converter(self, documentos):
+        # Conversão imediata de documentos fora das notas (ex.: consolidados).
+        if not self.ativa or not documentos:
+            return list(documentos)
+        pdfs, _ = self.conversor.converter(documentos).result()
+        return self._montar(documentos, pdfs)
+
+    def cancelar(self):
+        for _, futuro in self._futuros:
+            futuro.cancel()
+        wait([futuro for _, futuro in self._futuros])
+        self._futuros = []
+        self._acumulados = []
+
+    def retirar_avisos(self):
+        avisos, self.avisos = self.avisos, []
+        return avisos
+
+    def retirar_erros(self):
+        erros, self.erros = self.erros, []
+        return erros
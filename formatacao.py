@@ -0,0 +1,69 @@
+from datetime import datetime
+from functools import lru_cache
+
+
+MESES_PT = {
+    1: "Janeiro",
+    2: "Fevereiro",
+    3: "Março",
+    4: "Abril",
+    5: "Maio",
+    6: "Junho",
+    7: "Julho",
+    8: "Agosto",
+    9: "Setembro",
+    10: "Outubro",
+    11: "Novembro",
+    12: "Dezembro",
+}
+
+_SEPARADORES_PT_BR = str.maketrans(",.", ".,")
+
+_centavos_por_extenso = None
+
+
+def formatar_moeda_brasileira(valor):
+    return f"R$ {f'{valor:,.2f}'.translate(_SEPARADORES_PT_BR)}"
+
+
+def _por_extenso(numero):
+    # O num2words carrega os conversores de todos os idiomas ao ser importado;
+    # fica para a primeira nota, fora da abertura do app.
+    from num2words import num2words
+
+    return num2words(numero, lang="pt_BR")
+
+
+def _centavos_extenso(centavos):
+    global _centavos_por_extenso
+    if _centavos_por_extenso is None:
+        _centavos_por_extenso = tuple(_por_extenso(n) for n in range(100))
+    if centavos < 100:
+        return _centavos_por_extenso[centavos]
+    return _por_extenso(centavos)
+
+
+@lru_cache(maxsize=4096)
+def _inteiro_extenso(parte_inteira):
+    return _por_extenso(parte_inteira)
+
+
+def decimal_para_extenso(valor):
+    parte_inteira = int(valor)
+    centavos = int(round((valor % 1) * 100))
+    extenso = _inteiro_extenso(parte_inteira) + " reais"
+    if centavos > 0:
+        extenso += " e " + _centavos_extenso(centavos) + " centavos"
+    return extenso.capitalize()
+
+
+@lru_cache(maxsize=1024)
+def formatar_data_extenso(data):
+    data_obj = datetime.strptime(data, "%Y-%m-%d")
+    return f"{data_obj.day} de {MESES_PT[data_obj.month]} de {data_obj.year}"
+
+
+@lru_cache(maxsize=256)
+def formatar_competencia(competencia):
+    data_obj = datetime.strptime(competencia, "%Y-%m-%d")
+    return f"{MESES_PT[data_obj.month]} {data_obj.year}"
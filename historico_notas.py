@@ -0,0 +1,306 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from metricas import descrever_erro
+
+
+HISTORICO_ATIVO = os.environ.get("ASPDOC_HISTORICO", "1") != "0"
+DIRETORIO_HISTORICO = os.environ.get("ASPDOC_HISTORICO_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "aspdoc", "historico"
+)
+
+# Espaço máximo dos documentos guardados para reexportação; passando dele,
+# saem os que não são usados há mais tempo.
+TAMANHO_MAXIMO_DOCUMENTOS = int(os.environ.get("ASPDOC_HISTORICO_MAX_MB", "2048")) * 1024 * 1024
+
+PADRAO_COMPETENCIA = re.compile(r"^(\d{4})-(\d{2})")
+
+# Uma linha por nota processada em cada cidade; uma NF corrigida (mesmo
+# número, conteúdo diferente) ganha outra linha e só a mais recente fica como
+# `atual`, que é a que entra nos totais e nas reexportações.
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS notas (
+    id INTEGER PRIMARY KEY,
+    cidade TEXT NOT NULL,
+    secretaria TEXT NOT NULL,
+    numero_nf TEXT NOT NULL,
+    competencia TEXT NOT NULL,
+    data_emissao TEXT,
+    valor_centavos INTEGER,
+    hash_nota TEXT NOT NULL,
+    arquivo_origem TEXT,
+    processado_em REAL NOT NULL,
+    atual INTEGER NOT NULL DEFAULT 1,
+    UNIQUE (cidade, numero_nf, hash_nota)
+);
+CREATE INDEX IF NOT EXISTS idx_notas_competencia ON notas (cidade, competencia, secretaria, atual);
+CREATE INDEX IF NOT EXISTS idx_notas_hash ON notas (hash_nota);
+CREATE TABLE IF NOT EXISTS documentos (
+    nota_id INTEGER NOT NULL REFERENCES notas (id) ON DELETE CASCADE,
+    nome_arquivo TEXT NOT NULL,
+    hash_documento TEXT NOT NULL,
+    caminho TEXT NOT NULL,
+    PRIMARY KEY (nota_id, nome_arquivo)
+);
+"""
+
+
+def hash_nota(campos):
+    return hashlib.sha256(json.dumps(campos, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def competencia_da_nota(competencia):
+    # "2024-09-01T00:00:00" -> "2024-09"; vazio quando a nota não informa.
+    correspondencia = PADRAO_COMPETENCIA.match(competencia or "")
+    return f"{correspondencia.group(1)}-{correspondencia.group(2)}" if correspondencia else ""
+
+
+def _centavos(valor):
+    if valor is None:
+        return None
+    try:
+        return int(Decimal(valor) * 100)
+    except (InvalidOperation, ValueError):
+        return None
+
+
+class HistoricoNotas:
+    def __init__(self, diretorio=DIRETORIO_HISTORICO):
+        self.diretorio = diretorio
+        self.caminho_banco = os.path.join(diretorio, "historico.sqlite3")
+        self.diretorio_documentos = os.path.join(diretorio, "documentos")
+        self._local = threading.local()
+        self._esquema_criado = False
+        self._esquema_lock = threading.Lock()
+        self._bytes_desde_limpeza = 0
+        self._limpeza_lock = threading.Lock()
+
+    def _conexao(self):
+        # Uma conexão por thread: o lote grava na thread da tarefa enquanto a
+        # página consulta os totais na thread do script.
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None:
+            os.makedirs(self.diretorio, exist_ok=True)
+            conexao = sqlite3.connect(self.caminho_banco, timeout=30)
+            conexao.row_factory = sqlite3.Row
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("PRAGMA foreign_keys=ON")
+            with self._esquema_lock:
+                if not self._esquema_criado:
+                    conexao.executescript(ESQUEMA)
+                    self._esquema_criado = True
+            self._local.conexao = conexao
+        return conexao
+
+    def processada_em(self, cidade, numero_nf, hash_conteudo):
+        linha = self._conexao().execute(
+            "SELECT processado_em FROM notas WHERE cidade = ? AND numero_nf = ? AND hash_nota = ?",
+            (cidade, numero_nf, hash_conteudo),
+        ).fetchone()
+        return linha["processado_em"] if linha is not None else None
+
+    def _guardar_documento(self, conteudo):
+        # Arquivos endereçados pelo hash: reprocessar a mesma nota com o mesmo
+        # template não ocupa espaço de novo. A data de modificação marca o
+        # último uso para a limpeza.
+        digest = hashlib.sha256(conteudo).hexdigest()
+        caminho = os.path.join(self.diretorio_documentos, digest[:2], digest)
+        try:
+            os.utime(caminho)
+        except OSError:
+            diretorio = os.path.dirname(caminho)
+            os.makedirs(diretorio, exist_ok=True)
+            fd, temporario = tempfile.mkstemp(dir=diretorio, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as arquivo:
+                    arquivo.write(conteudo)
+                os.replace(temporario, caminho)
+            except BaseException:
+                os.remove(temporario)
+                raise
+        return digest, caminho
+
+    def registrar(self, cidade, resultado):
+        nota = resultado["nota"]
+        documentos = [
+            (nome_arquivo,) + self._guardar_documento(conteudo) for nome_arquivo, conteudo in resultado["documentos"]
+        ]
+        conexao = self._conexao()
+        with conexao:
+            conexao.execute(
+                "UPDATE notas SET atual = 0 WHERE cidade = ? AND numero_nf = ? AND hash_nota <> ?",
+                (cidade, resultado["numeroNF"], resultado["hash_nota"]),
+            )
+            nota_id = conexao.execute(
+                """
+                INSERT INTO notas (
+                    cidade, secretaria, numero_nf, competencia, data_emissao, valor_centavos,
+                    hash_nota, arquivo_origem, processado_em, atual
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT (cidade, numero_nf, hash_nota) DO UPDATE SET
+                    secretaria = excluded.secretaria,
+                    arquivo_origem = excluded.arquivo_origem,
+                    processado_em = excluded.processado_em,
+                    atual = 1
+                RETURNING id
+                """,
+                (
+                    cidade,
+                    resultado["template"],
+                    resultado["numeroNF"],
+                    competencia_da_nota(nota["competencia"]),
+                    nota["data"],
+                    _centavos(nota["valor"]),
+                    resultado["hash_nota"],
+                    resultado["arquivo"],
+                    time.time(),
+                ),
+            ).fetchone()["id"]
+            if documentos:
+                conexao.execute("DELETE FROM documentos WHERE nota_id = ?", (nota_id,))
+                conexao.executemany(
+                    "INSERT INTO documentos (nota_id, nome_arquivo, hash_documento, caminho) VALUES (?, ?, ?, ?)",
+                    [(nota_id, nome_arquivo, digest, caminho) for nome_arquivo, digest, caminho in documentos],
+                )
+
+        with self._limpeza_lock:
+            self._bytes_desde_limpeza += sum(len(conteudo) for _, conteudo in resultado["documentos"])
+            limpar = self._bytes_desde_limpeza > TAMANHO_MAXIMO_DOCUMENTOS // 10
+            if limpar:
+                self._bytes_desde_limpeza = 0
+        if limpar:
+            self.limpar_documentos()
+
+    def limpar_documentos(self, tamanho_maximo=TAMANHO_MAXIMO_DOCUMENTOS):
+        # As notas continuam no banco; a reexportação de uma competência cujos
+        # documentos saíram avisa que eles não estão mais guardados.
+        arquivos = []
+        total = 0
+        for raiz, _, nomes in os.walk(self.diretorio_documentos):
+            for nome in nomes:
+                if nome.endswith(".tmp"):
+                    continue
+                caminho = os.path.join(raiz, nome)
+                try:
+                    stat = os.stat(caminho)
+                except OSError:
+                    continue
+                arquivos.append((stat.st_mtime, stat.st_size, caminho))
+                total += stat.st_size
+
+        if total <= tamanho_maximo:
+            return
+
+        # Remove até sobrar uma folga de 10%, como no cache de documentos.
+        alvo = tamanho_maximo * 9 // 10
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= alvo:
+                break
+            try:
+                os.remove(caminho)
+            except OSError:
+                continue
+            total -= tamanho
+
+    def totais_por_competencia(self, cidade):
+        return [
+            dict(linha)
+            for linha in self._conexao().execute(
+                """
+                SELECT competencia, secretaria, COUNT(*) AS notas, SUM(valor_centavos) AS valor_centavos
+                FROM notas
+                WHERE cidade = ? AND atual = 1
+                GROUP BY competencia, secretaria
+                ORDER BY competencia DESC, secretaria
+                """,
+                (cidade,),
+            )
+        ]
+
+    def competencias(self, cidade):
+        return [
+            linha["competencia"]
+            for linha in self._conexao().execute(
+                "SELECT DISTINCT competencia FROM notas WHERE cidade = ? AND atual = 1 ORDER BY competencia DESC",
+                (cidade,),
+            )
+        ]
+
+    def iterar_documentos(self, cidade, competencia, avisos=None):
+        # Documentos guardados das notas atuais da competência, um de cada
+        # vez, para remontar o ZIP sem renderizar de novo.
+        avisos = avisos if avisos is not None else []
+        linhas = self._conexao().execute(
+            """
+            SELECT notas.numero_nf, documentos.nome_arquivo, documentos.caminho
+            FROM notas JOIN documentos ON documentos.nota_id = notas.id
+            WHERE notas.cidade = ? AND notas.competencia = ? AND notas.atual = 1
+            ORDER BY notas.secretaria, notas.numero_nf, documentos.nome_arquivo
+            """,
+            (cidade, competencia),
+        ).fetchall()
+        for linha in linhas:
+            try:
+                with open(linha["caminho"], "rb") as arquivo:
+                    yield linha["nome_arquivo"], arquivo.read()
+            except OSError:
+                avisos.append(f"Documento '{linha['nome_arquivo']}' da NF {linha['numero_nf']} não está mais guardado.")
+
+
+def marcar_notas_processadas(unidades, historico, cidade, pular=False):
+    # Confere cada nota no histórico antes de ir para o pool: a consulta usa o
+    # índice único (cidade, número, hash), sem ler o banco inteiro.
+    for unidade in unidades:
+        campos = unidade.get("campos")
+        if campos is not None:
+            unidade["hash_nota"] = hash_nota(campos)
+            if historico is not None:
+                processada_em = historico.processada_em(cidade, campos.get("Numero", "N/A"), unidade["hash_nota"])
+                if processada_em is not None:
+                    unidade["processada_em"] = processada_em
+                    unidade["pular"] = pular
+        yield unidade
+
+
+def registrar_resultado(historico, cidade, resultado):
+    # Só entra no histórico a nota que saiu inteira e com documentos para
+    # remontar: no modo consolidado a nota não tem documentos próprios e,
+    # registrada, seria pulada depois sem nada para reexportar. O histórico é
+    # um complemento, então uma falha ao gravar nele vira erro no relatório
+    # sem parar o lote.
+    if (
+        historico is None
+        or resultado.get("nota") is None
+        or not resultado["documentos"]
+        or resultado["pulada"]
+        or resultado["erros"]
+    ):
+        return []
+    try:
+        historico.registrar(cidade, resultado)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Erro ao gravar a NF {resultado['numeroNF']} no histórico: {str(e)}")
+        return [descrever_erro(resultado["arquivo"], "historico", e, resultado["numeroNF"])]
+    return []
+
+
+_historico = None
+_historico_lock = threading.Lock()
+
+
+def obter_historico():
+    global _historico
+    if not HISTORICO_ATIVO:
+        return None
+    with _historico_lock:
+        if _historico is None:
+            _historico = HistoricoNotas()
+        return _historico
@@ -0,0 +1,78 @@
+import os
+import xml.etree.ElementTree as ET
+
+
+TAMANHO_BLOCO_LEITURA = 64 * 1024
+
+CAMPOS_NFSE = ("Numero", "DataEmissao", "ValorServicos", "Competencia", "Discriminacao")
+
+
+def _nome_local(tag):
+    return tag.rpartition("}")[2]
+
+
+def _iterar_blocos(xml_file):
+    if isinstance(xml_file, (str, os.PathLike)):
+        with open(xml_file, "rb") as arquivo:
+            yield from _iterar_blocos(arquivo)
+    elif isinstance(xml_file, (bytes, bytearray, memoryview)):
+        dados = memoryview(xml_file)
+        for inicio in range(0, len(dados), TAMANHO_BLOCO_LEITURA):
+            yield dados[inicio:inicio + TAMANHO_BLOCO_LEITURA]
+    else:
+        while True:
+            bloco = xml_file.read(TAMANHO_BLOCO_LEITURA)
+            if not bloco:
+                return
+            yield bloco
+
+
+def _iterar_eventos(xml_file):
+    # XMLPullParser alimentado em blocos: lê o arquivo aos poucos e permite
+    # abandonar a leitura assim que os campos necessários aparecem.
+    parser = ET.XMLPullParser(events=("start", "end"))
+    for bloco in _iterar_blocos(xml_file):
+        parser.feed(bloco)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def iterar_campos_nfse(xml_file, primeira_apenas=False):
+    campos = None
+    pilha = []
+    for evento, elem in _iterar_eventos(xml_file):
+        if evento == "start":
+            pilha.append(elem)
+            if campos is None and _nome_local(elem.tag) == "InfNfse":
+                campos = {}
+            continue
+
+        pilha.pop()
+        if campos is not None:
+            tag = _nome_local(elem.tag)
+            if tag in CAMPOS_NFSE:
+                # Mesmo critério do antigo `.//Campo`: vale a primeira
+                # ocorrência dentro da InfNfse.
+                campos.setdefault(tag, elem.text)
+                if primeira_apenas and len(campos) == len(CAMPOS_NFSE):
+                    yield campos
+                    return
+            elif tag == "InfNfse":
+                yield campos
+                if primeira_apenas:
+                    return
+                campos = None
+
+        # O texto de cada elemento já foi lido no evento "end"; descartar a
+        # subárvore mantém a memória constante mesmo em lotes com milhares
+        # de CompNfse no mesmo arquivo.
+        elem.clear()
+        if pilha:
+            del pilha[-1][:]
+
+
+def ler_campos_nfse(xml_file):
+    for campos in iterar_campos_nfse(xml_file, primeira_apenas=True):
+        return campos
+    return None
@@ -0,0 +1,176 @@
+import cProfile
+import csv
+import io
+import json
+import os
+import pstats
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+ETAPAS = ("leitura", "classificacao", "renderizacao", "gravacao", "pdf", "zip")
+
+CAMPOS_ERRO = ("arquivo", "numeroNF", "documento", "etapa", "tipo", "mensagem")
+NOME_RELATORIO_ERROS = "_relatorio_erros.csv"
+
+
+@contextmanager
+def medir(tempos, etapa):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        if tempos is not None:
+            tempos[etapa] = tempos.get(etapa, 0.0) + time.perf_counter() - inicio
+
+
+def descrever_erro(arquivo, etapa, erro, numero_nf=None, documento=None):
+    # Uma linha do relatório de erros do lote. `erro` pode ser a exceção ou
+    # só um texto, para falhas que não vêm de exceção (ex.: nota sem template).
+    return {
+        "arquivo": arquivo or "",
+        "numeroNF": numero_nf or "",
+        "documento": documento or "",
+        "etapa": etapa,
+        "tipo": type(erro).__name__ if isinstance(erro, BaseException) else "",
+        "mensagem": str(erro),
+    }
+
+
+def erros_para_json(erros):
+    return json.dumps(list(erros), indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def erros_para_csv(erros):
+    saida = io.StringIO()
+    escritor = csv.DictWriter(saida, fieldnames=CAMPOS_ERRO)
+    escritor.writeheader()
+    escritor.writerows(erros)
+    return saida.getvalue().encode("utf-8")
+
+
+def _percentil(ordenados, p):
+    return ordenados[min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))]
+
+
+class ColetorMetricas:
+    def __init__(self):
+        self._notas = {}
+        self.inicio = time.perf_counter()
+        self.duracao = None
+
+    def registrar(self, indice, resultado):
+        linha = {
+            "arquivo": resultado["arquivo"],
+            "numeroNF": resultado.get("numeroNF") or "",
+            "template": resultado.get("template") or "",
+            "em_cache": resultado.get("em_cache", 0),
+        }
+        tempos = resultado.get("tempos", {})
+        for etapa in ETAPAS:
+            linha[etapa] = tempos.get(etapa, 0.0)
+        self._notas[indice] = linha
+
+    def _somar(self, etapa, tempos):
+        for indice, segundos in tempos.items():
+            if indice in self._notas:
+                self._notas[indice][etapa] += segundos
+
+    def registrar_pdf(self, tempos_pdf):
+        self._somar("pdf", tempos_pdf)
+
+    def registrar_zip(self, tempos_zip):
+        self._somar("zip", tempos_zip)
+
+    def finalizar(self):
+        self.duracao = time.perf_counter() - self.inicio
+
+    @property
+    def notas(self):
+        return [self._notas[indice] for indice in sorted(self._notas)]
+
+    def resumo(self):
+        linhas = []
+        notas = self.notas
+        for etapa in ETAPAS:
+            amostras = sorted(nota[etapa] for nota in notas)
+            if not amostras:
+                continue
+            total = sum(amostras)
+            linhas.append({
+                "etapa": etapa,
+                "total_s": round(total, 4),
+                "media_ms": round(total / len(amostras) * 1000, 2),
+                "p50_ms": round(_percentil(amostras, 50) * 1000, 2),
+                "p95_ms": round(_percentil(amostras, 95) * 1000, 2),
+                "max_ms": round(amostras[-1] * 1000, 2),
+            })
+        return linhas
+
+    def para_json(self):
+        return json.dumps(
+            {"duracao_s": self.duracao, "resumo": self.resumo(), "notas": self.notas},
+            indent=2,
+            ensure_ascii=False,
+        ).encode("utf-8")
+
+    def para_csv(self):
+        saida = io.StringIO()
+        campos = ["arquivo", "numeroNF", "template", "em_cache", *ETAPAS]
+        escritor = csv.DictWriter(saida, fieldnames=campos)
+        escritor.writeheader()
+        escritor.writerows(self.notas)
+        return saida.getvalue().encode("utf-8")
+
+
+class PerfilExecucao:
+    # Perfil opcional do lote: cProfile para CPU e tracemalloc para memória.
+    # Só enxerga o processo atual, então deve ser usado com o lote rodando
+    # sem pool de processos.
+    def __init__(self, ativo=True, linhas=60):
+        self.ativo = ativo
+        self.linhas = linhas
+        self._profiler = None
+        self._snapshot = None
+        self._pico_memoria = None
+
+    def __enter__(self):
+        if self.ativo:
+            tracemalloc.start()
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.ativo:
+            self._profiler.disable()
+            self._snapshot = tracemalloc.take_snapshot()
+            self._pico_memoria = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
+
+    def arquivos(self):
+        if not self.ativo or self._profiler is None:
+            return []
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            caminho = os.path.join(temp_dir, "perfil.pstats")
+            self._profiler.dump_stats(caminho)
+            with open(caminho, "rb") as f:
+                pstats_bytes = f.read()
+
+        texto_cpu = io.StringIO()
+        pstats.Stats(self._profiler, stream=texto_cpu).sort_stats("cumulative").print_stats(self.linhas)
+
+        texto_memoria = io.StringIO()
+        texto_memoria.write(f"Pico de memória rastreada: {self._pico_memoria / (1024 * 1024):.1f} MB\n\n")
+        for estatistica in self._snapshot.statistics("lineno")[: self.linhas]:
+            texto_memoria.write(f"{estatistica}\n")
+
+        return [
+            ("perfil.pstats", pstats_bytes),
+            ("perfil_cpu.txt", texto_cpu.getvalue().encode("utf-8")),
+            ("perfil_memoria.txt", texto_memoria.getvalue().encode("utf-8")),
+        ]
@@ -0,0 +1,135 @@
+import io
+import os
+import posixpath
+import tarfile
+import zipfile
+import zlib
+from itertools import islice
+
+
+EXTENSOES_PACOTE = (".zip", ".tar.gz", ".tgz")
+
+# Limites por pacote enviado: quantidade de arquivos dentro dele e bytes
+# descompactados, somando todos os XMLs. Os bytes são contados durante a
+# própria leitura, então um pacote que declara tamanhos falsos também para
+# no limite.
+LIMITE_ARQUIVOS_PACOTE = int(os.environ.get("ASPDOC_PACOTE_MAX_ARQUIVOS", "20000"))
+LIMITE_BYTES_PACOTE = int(os.environ.get("ASPDOC_PACOTE_MAX_MB", "512")) * 1024 * 1024
+
+
+class LimitePacoteExcedido(ValueError):
+    pass
+
+
+ERROS_PACOTE = (LimitePacoteExcedido, zipfile.BadZipFile, tarfile.TarError, zlib.error, OSError, EOFError)
+
+
+def eh_pacote(nome_arquivo):
+    return nome_arquivo.lower().endswith(EXTENSOES_PACOTE)
+
+
+class LeitorLimitado:
+    # Repassa as leituras do membro e para com LimitePacoteExcedido quando o
+    # total lido passa de `limite`.
+    def __init__(self, membro, limite, mensagem):
+        self.membro = membro
+        self.limite = limite
+        self.mensagem = mensagem
+        self.lidos = 0
+
+    def read(self, tamanho=-1):
+        restante = self.limite - self.lidos + 1
+        dados = self.membro.read(restante if tamanho is None or tamanho < 0 else min(tamanho, restante))
+        self.lidos += len(dados)
+        if self.lidos > self.limite:
+            raise LimitePacoteExcedido(self.mensagem)
+        return dados
+
+
+def _eh_caminho(conteudo):
+    return isinstance(conteudo, (str, os.PathLike))
+
+
+def _eh_xml(nome_membro):
+    nome = posixpath.basename(nome_membro)
+    return nome.lower().endswith(".xml") and not nome.startswith(".") and "__MACOSX/" not in nome_membro
+
+
+def _membros_zip(conteudo):
+    with zipfile.ZipFile(conteudo if _eh_caminho(conteudo) else io.BytesIO(conteudo)) as pacote:
+        for info in pacote.infolist():
+            if not info.is_dir():
+                yield info.filename, lambda info=info: pacote.open(info)
+
+
+def _membros_tar(conteudo):
+    # Modo de fluxo (r|gz): percorre o pacote uma vez, sem índice de membros.
+    if _eh_caminho(conteudo):
+        pacote = tarfile.open(conteudo, mode="r|gz")
+    else:
+        pacote = tarfile.open(fileobj=io.BytesIO(conteudo), mode="r|gz")
+    with pacote:
+        for info in pacote:
+            if info.isfile():
+                yield info.name, lambda info=info: pacote.extractfile(info)
+
+
+def _membros(nome_pacote, conteudo):
+    if nome_pacote.lower().endswith(".zip"):
+        return _membros_zip(conteudo)
+    return _membros_tar(conteudo)
+
+
+def iterar_pacote(nome_pacote, conteudo, limite_arquivos=LIMITE_ARQUIVOS_PACOTE, limite_bytes=LIMITE_BYTES_PACOTE):
+    # Entrega cada XML como o membro aberto, lido em blocos por quem consome;
+    # ele só vale até o próximo XML ser pedido. Nem o pacote nem um XML com
+    # milhares de notas fica descompactado inteiro na memória.
+    arquivos = 0
+    total = 0
+    mensagem = f"o pacote passa de {limite_bytes // (1024 * 1024)} MB descompactado"
+    for nome_membro, abrir in _membros(nome_pacote, conteudo):
+        arquivos += 1
+        if arquivos > limite_arquivos:
+            raise LimitePacoteExcedido(f"o pacote tem mais de {limite_arquivos} arquivos")
+        if not _eh_xml(nome_membro):
+            continue
+        with abrir() as membro:
+            leitor = LeitorLimitado(membro, limite_bytes - total, mensagem)
+            yield f"{nome_pacote}/{posixpath.normpath(nome_membro)}", leitor
+        total += leitor.lidos
+        if total > limite_bytes:
+            raise LimitePacoteExcedido(mensagem)
+
+
+def contar_xmls(entradas):
+    # Só para a barra de progresso: no ZIP vem do diretório central; no
+    # .tar.gz percorre os cabeçalhos sem guardar o conteúdo.
+    total = 0
+    for nome_arquivo, conteudo in entradas:
+        if not eh_pacote(nome_arquivo):
+            total += 1
+            continue
+        try:
+            membros = islice(_membros(nome_arquivo, conteudo), LIMITE_ARQUIVOS_PACOTE)
+            total += sum(1 for nome, _ in membros if _eh_xml(nome))
+        except ERROS_PACOTE:
+            continue
+    return total
+
+
+def iterar_xmls(entradas):
+    # Expande os pacotes sob demanda, na ordem das entradas, em trincas
+    # (nome, conteúdo, falha); XMLs soltos passam direto. O conteúdo de um XML
+    # de pacote é um arquivo aberto, que precisa ser lido antes de pedir a
+    # trinca seguinte. Um pacote ilegível ou acima dos limites sai como uma
+    # entrada com a falha, e os XMLs já lidos dele seguem no lote.
+    for nome_arquivo, conteudo in entradas:
+        if not eh_pacote(nome_arquivo):
+            yield nome_arquivo, conteudo, None
+            continue
+        try:
+            for nome_xml, dados in iterar_pacote(nome_arquivo, conteudo):
+                yield nome_xml, dados, None
+        except ERROS_PACOTE as e:
+            print(f"Erro ao ler o pacote {nome_arquivo}: {str(e)}")
+            yield nome_arquivo, None, e
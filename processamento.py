@@ -0,0 +1,958 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import posixpath
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+from itertools import islice
+
+from agendador import tamanho_documentos
+from cache_resultados import chave_resultado, guardar_resultado, obter_resultado
+from classificacao import obter_classificador
+from conversao_pdf import FORMATO_SAIDA_PADRAO, EtapaPdf
+from formatacao import decimal_para_extenso, formatar_competencia, formatar_data_extenso, formatar_moeda_brasileira
+from historico_notas import marcar_notas_processadas, obter_historico, registrar_resultado
+from leitura_nfse import iterar_campos_nfse, ler_campos_nfse
+from metricas import NOME_RELATORIO_ERROS, descrever_erro, erros_para_csv, medir
+from pacotes_xml import eh_pacote, iterar_xmls
+from registro_templates import DIRETORIO_TEMPLATES, obter_registro, templates_da_pasta
+
+
+LIMITE_ZIP_EM_MEMORIA = 32 * 1024 * 1024
+
+# DOCX já é um ZIP comprimido: comprimir de novo quase não reduz o tamanho,
+# então o padrão é só armazenar.
+MODOS_COMPRESSAO = {
+    "armazenar": (zipfile.ZIP_STORED, None),
+    "rapida": (zipfile.ZIP_DEFLATED, 1),
+    "maxima": (zipfile.ZIP_DEFLATED, 9),
+}
+MODO_COMPRESSAO_PADRAO = "armazenar"
+
+PADRAO_QUANTIDADE = re.compile(r"(\d+)\s+R\$")
+
+# Nota fictícia usada só para compilar os templates no aquecimento.
+CAMPOS_AQUECIMENTO = {
+    "Numero": "0",
+    "DataEmissao": "2024-01-01",
+    "ValorServicos": "1234.56",
+    "Competencia": "2024-01-01",
+    "Discriminacao": "Aquecimento dos templates, 1 R$",
+}
+
+
+def montar_dados_nota(campos, origem):
+    numero_nf = campos.get("Numero", "N/A")
+    data = campos.get("DataEmissao")
+    valor = campos.get("ValorServicos")
+    valor = Decimal(valor) if valor is not None else None
+    competencia = campos.get("Competencia")
+    discriminacao_text = campos.get("Discriminacao") or ""
+
+    match_quant = PADRAO_QUANTIDADE.search(discriminacao_text)
+    quant = match_quant.group(1) if match_quant else "N/A"
+
+    data_formatada = "N/A"
+    competencia_formatada = "N/A"
+    if data:
+        try:
+            data_formatada = formatar_data_extenso(data)
+        except ValueError:
+            print(f"Aviso: data inválida no XML {origem}.")
+
+    if competencia:
+        try:
+            competencia_formatada = formatar_competencia(competencia)
+        except ValueError:
+            print(f"Aviso: competência inválida no XML {origem}.")
+
+    return {
+        "numeroNF": numero_nf,
+        "data": data_formatada,
+        "valor": formatar_moeda_brasileira(valor) if valor else "N/A",
+        "valor_extenso": decimal_para_extenso(valor) if valor else "N/A",
+        "competencia": competencia_formatada,
+        "discriminacao": discriminacao_text,
+        "quant": quant,
+    }
+
+
+def extrair_informacoes_xml(xml_file):
+    try:
+        campos = ler_campos_nfse(xml_file)
+        if campos is None:
+            print(f"Aviso: tag 'InfNfse' não encontrada no XML {xml_file}.")
+            return None
+        return montar_dados_nota(campos, xml_file)
+    except Exception as e:
+        print(f"Erro ao processar o XML {xml_file}: {str(e)}")
+        return None
+
+
+def identificar_templates(dados, palavras_chave):
+    return obter_classificador(palavras_chave).classificar(dados["discriminacao"])
+
+
+def identificar_template(dados, palavras_chave):
+    templates = identificar_templates(dados, palavras_chave)
+    return templates[0] if templates else None
+
+
+def obter_template(template_path):
+    # cache_templates traz o docxtpl (python-docx, lxml e Jinja2): só é
+    # importado quando um template é usado, não ao abrir o app.
+    from cache_templates import obter_template
+
+    return obter_template(template_path)
+
+
+def renderizar_com_cache(template_path, dados, estatisticas=None, consolidado=False):
+    template = obter_template(template_path)
+    chave = chave_resultado(dados, f"{template.hash}:consolidado" if consolidado else template.hash)
+    conteudo = obter_resultado(chave)
+    if conteudo is not None:
+        if estatisticas is not None:
+            estatisticas["em_cache"] = estatisticas.get("em_cache", 0) + 1
+        return conteudo
+
+    tempos = estatisticas.setdefault("tempos", {}) if estatisticas is not None else None
+    conteudo = template.renderizar(dados, tempos, consolidado)
+    guardar_resultado(chave, conteudo)
+    return conteudo
+
+
+def gerar_documentos_em_memoria(
+    template_dir, dados, nome_base, avisos=None, estatisticas=None, consolidado=False, erros=None
+):
+    arquivos_gerados = []
+    avisos = avisos if avisos is not None else []
+    erros = erros if erros is not None else []
+
+    for template_name in templates_da_pasta(template_dir):
+        template_path = os.path.join(template_dir, template_name)
+        if not os.path.exists(template_path):
+            avisos.append(f"Template '{template_path}' não encontrado. Pulando...")
+            continue
+
+        output_filename = f"{nome_base}_{template_name}"
+        try:
+            arquivos_gerados.append(
+                (output_filename, renderizar_com_cache(template_path, dados, estatisticas, consolidado))
+            )
+        except Exception as e:
+            avisos.append(f"Erro ao gerar documento '{template_name}': {e}")
+            erros.append(descrever_erro(None, "renderizacao", e, dados.get("numeroNF"), output_filename))
+            continue
+
+    return arquivos_gerados
+
+
+def nome_base_nota(dados, xml_file_name):
+    numero_nf = (dados.get("numeroNF") or "").strip()
+    if numero_nf and numero_nf != "N/A":
+        return re.sub(r"[^\w.-]", "_", numero_nf)
+    # Sem número, vale o nome do XML sem as pastas: dentro de pacotes ele vem
+    # como "<pacote>/<caminho>". Nomes repetidos ficam para o nome_unico.
+    nome = os.path.splitext(posixpath.basename(xml_file_name.replace("\\", "/")))[0]
+    return re.sub(r"[^\w.-]", "_", nome) or "nota"
+
+
+def nome_unico(nome_arquivo, usados):
+    candidato = nome_arquivo
+    base, extensao = os.path.splitext(nome_arquivo)
+    contador = 2
+    while candidato in usados:
+        candidato = f"{base}_{contador}{extensao}"
+        contador += 1
+    usados.add(candidato)
+    return candidato
+
+
+def iterar_notas(xmls):
+    # `xmls` pode trazer pacotes .zip/.tar.gz, expandidos aqui um XML por vez.
+    for indice_arquivo, (xml_file_name, xml_path, falha) in enumerate(iterar_xmls(xmls)):
+        unidade = {"arquivo": xml_file_name, "indice_arquivo": indice_arquivo}
+        if falha is not None:
+            yield dict(
+                unidade,
+                erro=f"Pulando {xml_file_name}: {falha}.",
+                falha=descrever_erro(xml_file_name, "leitura", falha),
+            )
+            continue
+
+        encontrou = False
+        inicio = time.perf_counter()
+        try:
+            for campos in iterar_campos_nfse(xml_path):
+                encontrou = True
+                yield dict(unidade, campos=campos, tempos={"leitura": time.perf_counter() - inicio})
+                inicio = time.perf_counter()
+        except Exception as e:
+            print(f"Erro ao processar o XML {xml_file_name}: {str(e)}")
+            yield dict(
+                unidade,
+                erro=f"Pulando {xml_file_name}: não foi possível ler a NFS-e.",
+                falha=descrever_erro(xml_file_name, "leitura", e),
+            )
+            continue
+
+        if not encontrou:
+            yield dict(
+                unidade,
+                erro=f"Pulando {xml_file_name}: tag 'InfNfse' não encontrada.",
+                falha=descrever_erro(xml_file_name, "leitura", "tag 'InfNfse' não encontrada"),
+            )
+
+
+def processar_nota(unidade, templates_base_dir, palavras_chave, consolidar=False):
+    xml_file_name = unidade["arquivo"]
+    resultado = {
+        "arquivo": xml_file_name,
+        "indice_arquivo": unidade["indice_arquivo"],
+        "numeroNF": None,
+        "template": None,
+        "ambigua": False,
+        "documentos": [],
+        "em_cache": 0,
+        "tempos": dict(unidade.get("tempos", {})),
+        "avisos": [],
+        "erros": [],
+        "hash_nota": unidade.get("hash_nota"),
+        "pulada": False,
+    }
+    if "erro" in unidade:
+        resultado["avisos"].append(unidade["erro"])
+        resultado["erros"].append(unidade["falha"])
+        return resultado
+
+    if unidade.get("processada_em") is not None:
+        numero_nf = unidade["campos"].get("Numero", "N/A")
+        quando = time.strftime("%d/%m/%Y %H:%M", time.localtime(unidade["processada_em"]))
+        if unidade.get("pular"):
+            resultado["numeroNF"] = numero_nf
+            resultado["pulada"] = True
+            resultado["avisos"].append(f"NF {numero_nf} de {xml_file_name} já foi processada em {quando}; pulando.")
+            return resultado
+        resultado["avisos"].append(f"NF {numero_nf} de {xml_file_name} já tinha sido processada em {quando}.")
+
+    try:
+        dados = montar_dados_nota(unidade["campos"], xml_file_name)
+    except Exception as e:
+        print(f"Erro ao processar o XML {xml_file_name}: {str(e)}")
+        resultado["avisos"].append(f"Pulando {xml_file_name}: não foi possível ler a NFS-e.")
+        resultado["erros"].append(descrever_erro(xml_file_name, "leitura", e))
+        return resultado
+
+    resultado["numeroNF"] = dados["numeroNF"]
+    with medir(resultado["tempos"], "classificacao"):
+        candidatos = identificar_templates(dados, palavras_chave)
+    if not candidatos:
+        resultado["avisos"].append(
+            f"Nenhum template correspondente encontrado para {xml_file_name} (NF {dados['numeroNF']})."
+        )
+        resultado["erros"].append(
+            descrever_erro(xml_file_name, "classificacao", "nenhum template correspondente", dados["numeroNF"])
+        )
+        return resultado
+
+    template_folder = candidatos[0]
+    if len(candidatos) > 1:
+        resultado["ambigua"] = True
+        resultado["avisos"].append(
+            f"NF {dados['numeroNF']} de {xml_file_name} corresponde a mais de um template "
+            f"({', '.join(candidatos)}); usando {template_folder}."
+        )
+
+    resultado["template"] = template_folder
+    campos = unidade["campos"]
+    resultado["nota"] = {
+        "arquivo": xml_file_name,
+        "dados": dados,
+        "valor": Decimal(campos["ValorServicos"]) if campos.get("ValorServicos") else None,
+        "data": campos.get("DataEmissao"),
+        "competencia": campos.get("Competencia"),
+    }
+    if consolidar:
+        # No modo consolidado a nota só é classificada aqui; os documentos
+        # saem uma vez por secretaria, no fim do lote.
+        return resultado
+
+    template_dir = os.path.join(templates_base_dir, template_folder)
+    estatisticas = {"tempos": resultado["tempos"]}
+    resultado["documentos"] = gerar_documentos_em_memoria(
+        template_dir,
+        dados,
+        nome_base_nota(dados, xml_file_name),
+        resultado["avisos"],
+        estatisticas,
+        erros=resultado["erros"],
+    )
+    for erro in resultado["erros"]:
+        erro["arquivo"] = xml_file_name
+    resultado["em_cache"] = estatisticas.get("em_cache", 0)
+    return resultado
+
+
+def aquecer_templates(diretorio_base=DIRETORIO_TEMPLATES, cidades=None):
+    # Carrega e compila todos os templates do registro de uma vez, no início
+    # do processo, e aponta templates faltando antes que alguma nota precise
+    # deles.
+    inicio = time.perf_counter()
+    relatorio = {"templates": 0, "erros": [], "duracao_s": None}
+    dados = montar_dados_nota(CAMPOS_AQUECIMENTO, "aquecimento")
+
+    registro = obter_registro(diretorio_base)
+    for nome_cidade, cidade in registro.cidades.items():
+        if cidades and nome_cidade not in cidades:
+            continue
+        for secretaria in cidade.secretarias:
+            for template_name in secretaria.templates:
+                template_path = os.path.join(secretaria.diretorio, template_name)
+                if not os.path.exists(template_path):
+                    # Já listado em `registro.erros`.
+                    continue
+                try:
+                    obter_template(template_path).aquecer(dados)
+                    relatorio["templates"] += 1
+                except Exception as e:
+                    relatorio["erros"].append(f"Erro ao carregar o template '{template_path}': {e}")
+
+    relatorio["duracao_s"] = time.perf_counter() - inicio
+    return relatorio
+
+
+def _iniciar_worker():
+    aquecer_templates()
+
+
+def _worker_pronto():
+    return os.getpid()
+
+
+def numero_nota(nota):
+    # <Numero/> vazio chega como None; vale o nome do XML, como no
+    # nome_base_nota.
+    numero_nf = (nota["dados"]["numeroNF"] or "").strip()
+    if numero_nf and numero_nf != "N/A":
+        return numero_nf
+    return nome_base_nota({}, nota.get("arquivo") or "N/A")
+
+
+def montar_dados_consolidados(notas):
+    # Contexto de um documento do lote: `notas` traz os dados de cada nota
+    # para as linhas da tabela e as demais chaves trazem os valores agregados,
+    # para que o texto fora da tabela continue funcionando.
+    total = sum((nota["valor"] for nota in notas if nota["valor"] is not None), Decimal(0))
+    datas = sorted(nota["data"] for nota in notas if nota["data"])
+    competencias = sorted({nota["competencia"] for nota in notas if nota["competencia"]})
+    quantidades = [nota["dados"]["quant"] for nota in notas]
+
+    data_formatada = "N/A"
+    if datas:
+        try:
+            data_formatada = formatar_data_extenso(datas[-1])
+        except ValueError:
+            pass
+    competencias_formatadas = []
+    for competencia in competencias:
+        try:
+            competencias_formatadas.append(formatar_competencia(competencia))
+        except ValueError:
+            continue
+
+    return {
+        "notas": [dict(nota["dados"], numeroNF=numero_nota(nota)) for nota in notas],
+        "quantidade_notas": len(notas),
+        "numeroNF": ", ".join(numero_nota(nota) for nota in notas),
+        "data": data_formatada,
+        "valor": formatar_moeda_brasileira(total),
+        "valor_extenso": decimal_para_extenso(total) if total else "N/A",
+        "total": formatar_moeda_brasileira(total),
+        "total_extenso": decimal_para_extenso(total) if total else "N/A",
+        "competencia": ", ".join(competencias_formatadas) or "N/A",
+        "discriminacao": "",
+        "quant": str(sum(int(q) for q in quantidades)) if all(q.isdigit() for q in quantidades) else "N/A",
+    }
+
+
+class ConsolidacaoLote:
+    # Junta as notas classificadas do lote por secretaria e gera, no fim, um
+    # documento de cada template por secretaria, em uma única renderização.
+    def __init__(self, templates_base_dir):
+        self.templates_base_dir = templates_base_dir
+        self._notas = {}
+
+    def registrar(self, indice, resultado):
+        if resultado.get("nota") is not None:
+            self._notas.setdefault(resultado["template"], []).append((indice, resultado["nota"]))
+
+    @property
+    def total_notas(self):
+        return sum(len(notas) for notas in self._notas.values())
+
+    def gerar_documentos(self, avisos=None, estatisticas=None, erros=None):
+        documentos = []
+        for template_folder in sorted(self._notas):
+            notas = [nota for _, nota in sorted(self._notas[template_folder], key=lambda item: item[0])]
+            documentos.extend(
+                gerar_documentos_em_memoria(
+                    os.path.join(self.templates_base_dir, template_folder),
+                    montar_dados_consolidados(notas),
+                    template_folder,
+                    avisos,
+                    estatisticas,
+                    consolidado=True,
+                    erros=erros,
+                )
+            )
+        return documentos
+
+
+def numero_workers_padrao():
+    return os.cpu_count() or 1
+
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def obter_executor(workers):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # spawn evita herdar as threads do servidor Streamlit no fork.
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_iniciar_worker,
+            )
+            _executor_workers = workers
+        return _executor
+
+
+def iniciar_executor(workers):
+    # Sobe os processos do pool sem esperar por eles: o primeiro lote já
+    # encontra os workers com os templates aquecidos.
+    if workers <= 1:
+        return None
+    executor = obter_executor(workers)
+    for _ in range(workers):
+        executor.submit(_worker_pronto)
+    return executor
+
+
+def descartar_executor(esperar=False):
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=esperar, cancel_futures=True)
+        _executor = None
+        _executor_workers = None
+
+
+def processar_lote(
+    unidades, templates_base_dir, palavras_chave, workers=None, janela=None, consolidar=False, memoria=None
+):
+    workers = workers or numero_workers_padrao()
+
+    if workers <= 1:
+        for indice, unidade in enumerate(unidades):
+            yield indice, processar_nota(unidade, templates_base_dir, palavras_chave, consolidar)
+        return
+
+    # As unidades são consumidas sob demanda e nenhuma nota é enviada mais do
+    # que `janela` posições à frente da mais antiga ainda não concluída: assim
+    # nem a leitura de XMLs com milhares de notas nem o buffer de reordenação
+    # de quem consome o lote crescem com o tamanho do lote. Com `memoria`
+    # (um OrcamentoMemoria compartilhado entre lotes), cada nota também
+    # reserva os bytes dos seus documentos até ser entregue a quem consome.
+    janela = janela or workers * 4
+    executor = obter_executor(workers)
+    unidades = iter(unidades)
+    futuros = {}
+    reservas = {}
+    concluidos = set()
+    proximo_envio = 0
+    menor_pendente = 0
+    esgotado = False
+    try:
+        while True:
+            while not esgotado and proximo_envio - menor_pendente < janela:
+                if memoria is not None:
+                    reserva = memoria.reservar(forcar=not futuros)
+                    if reserva is None:
+                        break
+                    reservas[proximo_envio] = reserva
+                unidade = next(unidades, None)
+                if unidade is None:
+                    esgotado = True
+                    break
+                futuro = executor.submit(processar_nota, unidade, templates_base_dir, palavras_chave, consolidar)
+                futuros[futuro] = (proximo_envio, unidade)
+                proximo_envio += 1
+
+            if not futuros:
+                break
+
+            prontos, _ = wait(futuros, return_when=FIRST_COMPLETED)
+            for futuro in prontos:
+                indice, unidade = futuros.pop(futuro)
+                try:
+                    resultado = futuro.result()
+                except BrokenProcessPool:
+                    descartar_executor()
+                    raise
+                except Exception as e:
+                    resultado = {
+                        "arquivo": unidade["arquivo"],
+                        "indice_arquivo": unidade["indice_arquivo"],
+                        "numeroNF": None,
+                        "template": None,
+                        "ambigua": False,
+                        "documentos": [],
+                        "em_cache": 0,
+                        "tempos": dict(unidade.get("tempos", {})),
+                        "avisos": [f"Erro ao processar o XML {unidade['arquivo']}: {e}"],
+                        "erros": [descrever_erro(unidade["arquivo"], "processamento", e)],
+                        "hash_nota": unidade.get("hash_nota"),
+                        "pulada": False,
+                    }
+                concluidos.add(indice)
+                if memoria is not None:
+                    reservas[indice] = memoria.ajustar(reservas[indice], tamanho_documentos(resultado))
+                yield indice, resultado
+                if memoria is not None:
+                    memoria.liberar(reservas.pop(indice))
+
+            while menor_pendente in concluidos:
+                concluidos.remove(menor_pendente)
+                menor_pendente += 1
+    finally:
+        for futuro in futuros:
+            futuro.cancel()
+        if memoria is not None:
+            for reserva in reservas.values():
+                memoria.liberar(reserva)
+
+
+def numero_threads_compressao():
+    return min(4, os.cpu_count() or 1)
+
+
+_executor_compressao = None
+_executor_compressao_lock = threading.Lock()
+
+
+def obter_executor_compressao():
+    global _executor_compressao
+    with _executor_compressao_lock:
+        if _executor_compressao is None:
+            _executor_compressao = ThreadPoolExecutor(
+                max_workers=numero_threads_compressao(),
+                thread_name_prefix="aspdoc-zip",
+            )
+        return _executor_compressao
+
+
+def comprimir_membro(conteudo, nivel):
+    # Roda nas threads de compressão; o zlib libera o GIL durante o deflate.
+    inicio = time.perf_counter()
+    crc = zlib.crc32(conteudo)
+    if nivel is not None:
+        compressor = zlib.compressobj(nivel, zlib.DEFLATED, -15)
+        conteudo = compressor.compress(conteudo) + compressor.flush()
+    return crc, conteudo, time.perf_counter() - inicio
+
+
+# O zipfile não grava membros já comprimidos nem fecha uma cópia do arquivo
+# em andamento. Só _registrar_membro usa os internos dele para isso, e só
+# nas versões em que eles foram conferidos; nas demais o ZipEmStreaming usa
+# a API pública e comprime cada membro no writestr, sem as threads.
+VERSOES_INTERNOS_ZIP = ((3, 8), (3, 13))
+USAR_INTERNOS_ZIP = VERSOES_INTERNOS_ZIP[0] <= sys.version_info[:2] <= VERSOES_INTERNOS_ZIP[1]
+
+
+def _registrar_membro(zip_file, zinfo, dados=None):
+    # Com `dados`, grava o cabeçalho local e os dados na posição atual; sem,
+    # o membro já está no arquivo, em zinfo.header_offset. Em ambos os casos
+    # ele entra no diretório central gravado pelo close().
+    with zip_file._lock:
+        zip_file._writecheck(zinfo)
+        zip_file._didModify = True
+        if dados is not None:
+            zinfo.header_offset = zip_file.fp.tell()
+            zip_file.fp.write(zinfo.FileHeader())
+            zip_file.fp.write(dados)
+            zip_file.start_dir = zip_file.fp.tell()
+        zip_file.filelist.append(zinfo)
+        zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+def _novo_membro(nome_arquivo, compress_type, date_time=None):
+    zinfo = zipfile.ZipInfo(nome_arquivo, date_time or time.localtime()[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0o600 << 16
+    return zinfo
+
+
+def gravar_membro_comprimido(zip_file, nome_arquivo, tamanho, crc, dados, compress_type):
+    zinfo = _novo_membro(nome_arquivo, compress_type)
+    zinfo.file_size = tamanho
+    zinfo.compress_size = len(dados)
+    zinfo.CRC = crc
+    _registrar_membro(zip_file, zinfo, dados)
+
+
+def fechar_copia_zip(copia, membros, compress_type, nivel, internos=True):
+    # `copia` é um arquivo com os bytes de um ZIP ainda aberto até o fim do
+    # último membro; `membros` traz, para cada um, o ZipInfo e a posição em
+    # que os dados dele terminam. Devolve um arquivo com o ZIP completo só
+    # com esses membros.
+    if internos:
+        copia.seek(0, io.SEEK_END)
+        with zipfile.ZipFile(copia, "w", compress_type) as zip_copia:
+            for zinfo, _ in membros:
+                _registrar_membro(zip_copia, zinfo)
+        return copia
+
+    # Sem os internos, cada membro é descomprimido e gravado de novo. Sem
+    # descritor de dados (o arquivo aceita seek), os dados são os últimos
+    # compress_size bytes do membro.
+    destino = tempfile.SpooledTemporaryFile(max_size=LIMITE_ZIP_EM_MEMORIA, suffix=".zip")
+    with copia, zipfile.ZipFile(destino, "w", compress_type) as zip_copia:
+        for zinfo, fim in membros:
+            copia.seek(fim - zinfo.compress_size)
+            dados = copia.read(zinfo.compress_size)
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                dados = zlib.decompress(dados, -15)
+            zip_copia.writestr(
+                _novo_membro(zinfo.filename, zinfo.compress_type, zinfo.date_time), dados, compresslevel=nivel
+            )
+    return destino
+
+
+class ZipEmStreaming:
+    # Recebe os documentos na ordem em que as notas terminam, mas grava no ZIP
+    # na ordem original do lote. O arquivo fica em memória até
+    # `limite_memoria` bytes e depois passa para um temporário em disco.
+    # A compressão de cada documento começa assim que ele chega, em threads,
+    # e a gravação em ordem só espera pelo resultado (sem USAR_INTERNOS_ZIP,
+    # as threads só calculam o CRC). Enquanto o lote roda,
+    # `ler_parcial` entrega um ZIP válido com o que já foi gravado.
+    def __init__(self, limite_memoria=LIMITE_ZIP_EM_MEMORIA, destino=None, modo=MODO_COMPRESSAO_PADRAO):
+        if destino is None:
+            self.arquivo = tempfile.SpooledTemporaryFile(max_size=limite_memoria, suffix=".zip")
+        else:
+            self.arquivo = open(destino, "w+b")
+        self.modo = modo
+        self._compress_type, self._nivel = MODOS_COMPRESSAO[modo]
+        self.total_documentos = 0
+        self.bytes_originais = 0
+        self.bytes_comprimidos = 0
+        self.tempo_compressao = 0.0
+        self.duracao_finalizacao = None
+        self.finalizado = False
+        self._internos = USAR_INTERNOS_ZIP
+        self._zip = zipfile.ZipFile(self.arquivo, "w", self._compress_type)
+        self._fim_membros = self.arquivo.tell()
+        self._fins = []
+        self._nomes = set()
+        self._pendentes = {}
+        self._proximo = 0
+        self._lock = threading.Lock()
+        self.tempos = {}
+
+    def _comprimir(self, documentos):
+        executor = obter_executor_compressao()
+        nivel = self._nivel if self._internos else None
+        return [
+            (nome_arquivo, len(conteudo), executor.submit(comprimir_membro, conteudo, nivel))
+            for nome_arquivo, conteudo in documentos
+        ]
+
+    def adicionar(self, indice, documentos):
+        self._pendentes[indice] = self._comprimir(documentos)
+        while self._proximo in self._pendentes:
+            inicio = time.perf_counter()
+            self._gravar(self._pendentes.pop(self._proximo))
+            self.tempos[self._proximo] = time.perf_counter() - inicio
+            self._proximo += 1
+
+    def adicionar_documentos(self, documentos):
+        # Documentos que não pertencem a uma nota, como os consolidados do lote.
+        self._gravar(self._comprimir(documentos))
+
+    def adicionar_arquivo(self, nome_arquivo, conteudo):
+        self._gravar(self._comprimir([(nome_arquivo, conteudo)]), contar=False)
+
+    def _gravar(self, comprimidos, contar=True):
+        for nome_arquivo, tamanho, futuro in comprimidos:
+            crc, dados, duracao = futuro.result()
+            with self._lock:
+                nome_arquivo = nome_unico(nome_arquivo, self._nomes)
+                if self._internos:
+                    gravar_membro_comprimido(self._zip, nome_arquivo, tamanho, crc, dados, self._compress_type)
+                else:
+                    inicio = time.perf_counter()
+                    zinfo = _novo_membro(nome_arquivo, self._compress_type)
+                    self._zip.writestr(zinfo, dados, compresslevel=self._nivel)
+                    duracao += time.perf_counter() - inicio
+                self._fim_membros = self.arquivo.tell()
+                self._fins.append(self._fim_membros)
+                comprimido = self._zip.infolist()[-1].compress_size
+            self.bytes_originais += tamanho
+            self.bytes_comprimidos += comprimido
+            self.tempo_compressao += duracao
+            if contar:
+                self.total_documentos += 1
+
+    @property
+    def taxa_compressao(self):
+        if not self.bytes_originais:
+            return None
+        return self.bytes_comprimidos / self.bytes_originais
+
+    def resumo_compressao(self):
+        return {
+            "modo": self.modo,
+            "bytes_originais": self.bytes_originais,
+            "bytes_comprimidos": self.bytes_comprimidos,
+            "taxa": self.taxa_compressao,
+            "tempo_compressao_s": self.tempo_compressao,
+            "tempo_finalizacao_s": self.duracao_finalizacao,
+        }
+
+    def finalizar(self):
+        inicio = time.perf_counter()
+        for indice in sorted(self._pendentes):
+            self._gravar(self._pendentes.pop(indice))
+        with self._lock:
+            self._zip.close()
+            self.finalizado = True
+        self.duracao_finalizacao = time.perf_counter() - inicio
+        return self
+
+    def ler(self):
+        with self._lock:
+            self.arquivo.seek(0)
+            return self.arquivo.read()
+
+    def ler_parcial(self):
+        # Copia os membros já gravados e monta um diretório central só para
+        # eles, sem interromper o lote: o ZIP em andamento continua aberto. A
+        # cópia passa para o disco como o próprio ZIP, e só o resultado
+        # final fica em memória, para o download.
+        copia = tempfile.SpooledTemporaryFile(max_size=LIMITE_ZIP_EM_MEMORIA, suffix=".zip")
+        try:
+            with self._lock:
+                if self.finalizado:
+                    self.arquivo.seek(0)
+                    return self.arquivo.read()
+                posicao = self.arquivo.tell()
+                self.arquivo.seek(0)
+                shutil.copyfileobj(self.arquivo, copia)
+                self.arquivo.seek(posicao)
+                copia.truncate(self._fim_membros)
+                membros = list(zip(self._zip.infolist(), self._fins))
+            copia = fechar_copia_zip(copia, membros, self._compress_type, self._nivel, self._internos)
+            copia.seek(0)
+            return copia.read()
+        finally:
+            copia.close()
+
+    def fechar(self):
+        # Lotes interrompidos chegam aqui com o ZIP ainda aberto.
+        self._zip.close()
+        self.arquivo.close()
+
+
+def exportar_competencia(historico, cidade, competencia, compressao=MODO_COMPRESSAO_PADRAO, avisos=None):
+    # Remonta o ZIP de uma competência com os documentos guardados no
+    # histórico, sem ler XML nem renderizar; os documentos são comprimidos em
+    # grupos para não carregar a competência inteira de uma vez.
+    zip_saida = ZipEmStreaming(modo=compressao)
+    documentos = historico.iterar_documentos(cidade, competencia, avisos)
+    try:
+        while True:
+            grupo = list(islice(documentos, numero_threads_compressao() * 2))
+            if not grupo:
+                break
+            zip_saida.adicionar_documentos(grupo)
+        zip_saida.finalizar()
+    except Exception:
+        zip_saida.fechar()
+        raise
+    return zip_saida
+
+
+def descrever_compressao(zip_saida):
+    resumo = zip_saida.resumo_compressao()
+    return (
+        f"modo {resumo['modo']}, {resumo['bytes_originais'] / (1024 * 1024):.1f} MB -> "
+        f"{resumo['bytes_comprimidos'] / (1024 * 1024):.1f} MB ({resumo['taxa']:.1%}), "
+        f"compressão {resumo['tempo_compressao_s']:.2f} s"
+    )
+
+
+def descrever_resultado(resultado):
+    origem = resultado["arquivo"]
+    if resultado.get("numeroNF"):
+        origem = f"{origem} [NF {resultado['numeroNF']}]"
+    if resultado.get("pulada"):
+        return f"{origem} -> já processada"
+    descricao = f"{origem} -> {resultado['template'] or 'ignorado'}"
+    if resultado.get("ambigua"):
+        descricao += " (ambígua)"
+    return descricao
+
+
+def listar_xmls(xml_dir):
+    return [
+        (xml_file, os.path.join(xml_dir, xml_file))
+        for xml_file in sorted(os.listdir(xml_dir))
+        if xml_file.endswith(".xml") or eh_pacote(xml_file)
+    ]
+
+
+def remover_xmls_duplicados(xmls):
+    # Mantém a ordem original e descarta conteúdos repetidos antes de qualquer
+    # leitura, mesmo que o nome do arquivo seja outro.
+    unicos = []
+    duplicados = []
+    vistos = {}
+    for xml_file_name, conteudo in xmls:
+        digest = hashlib.sha256(conteudo).digest()
+        if digest in vistos:
+            duplicados.append((xml_file_name, vistos[digest]))
+            continue
+        vistos[digest] = xml_file_name
+        unicos.append((xml_file_name, conteudo))
+    return unicos, duplicados
+
+
+def gravar_documentos_lote(
+    xmls,
+    templates_base_dir,
+    palavras_chave,
+    destino,
+    workers=None,
+    compressao=MODO_COMPRESSAO_PADRAO,
+    consolidar=False,
+    formato=FORMATO_SAIDA_PADRAO,
+    pular_processadas=False,
+):
+    gerados = []
+    usados = set()
+    erros = []
+    historico = obter_historico()
+    cidade = os.path.basename(os.path.normpath(templates_base_dir))
+    saida_zip = None
+    consolidacao = ConsolidacaoLote(templates_base_dir) if consolidar else None
+    etapa_pdf = EtapaPdf(formato)
+    if destino.lower().endswith(".zip"):
+        saida_zip = ZipEmStreaming(destino=destino, modo=compressao)
+    else:
+        os.makedirs(destino, exist_ok=True)
+
+    def gravar_em_diretorio(documentos):
+        for nome_arquivo, conteudo in documentos:
+            destino_path = os.path.join(destino, nome_unico(nome_arquivo, usados))
+            with open(destino_path, "wb") as f:
+                f.write(conteudo)
+            gerados.append(destino_path)
+
+    def gravar(prontos):
+        for indice, documentos in prontos:
+            if saida_zip is not None:
+                saida_zip.adicionar(indice, documentos)
+                gerados.extend(nome_arquivo for nome_arquivo, _ in documentos)
+            else:
+                gravar_em_diretorio(documentos)
+        for aviso in etapa_pdf.retirar_avisos():
+            print(f"Aviso: {aviso}")
+        erros.extend(etapa_pdf.retirar_erros())
+
+    try:
+        unidades = marcar_notas_processadas(iterar_notas(xmls), historico, cidade, pular_processadas)
+        lote = processar_lote(unidades, templates_base_dir, palavras_chave, workers, consolidar=consolidar)
+        for concluidos, (indice, resultado) in enumerate(lote, start=1):
+            for aviso in resultado["avisos"]:
+                print(f"Aviso: {aviso}")
+            erros.extend(resultado["erros"])
+            erros.extend(registrar_resultado(historico, cidade, resultado))
+
+            if consolidacao is not None:
+                consolidacao.registrar(indice, resultado)
+            gravar(etapa_pdf.adicionar(indice, resultado["documentos"]))
+
+            print(f"[{concluidos}] {descrever_resultado(resultado)}")
+
+        gravar(etapa_pdf.finalizar())
+        if consolidacao is not None:
+            avisos = []
+            documentos = etapa_pdf.converter(consolidacao.gerar_documentos(avisos, erros=erros))
+            avisos.extend(etapa_pdf.retirar_avisos())
+            erros.extend(etapa_pdf.retirar_erros())
+            for aviso in avisos:
+                print(f"Aviso: {aviso}")
+            if saida_zip is not None:
+                saida_zip.adicionar_documentos(documentos)
+                gerados.extend(nome_arquivo for nome_arquivo, _ in documentos)
+            else:
+                gravar_em_diretorio(documentos)
+            print(f"{len(documentos)} documento(s) consolidado(s) de {consolidacao.total_notas} nota(s).")
+    finally:
+        # Com ou sem erro no meio do lote, o que já foi gerado fica gravado,
+        # junto com o relatório de erros.
+        etapa_pdf.cancelar()
+        if erros:
+            if saida_zip is not None:
+                saida_zip.adicionar_arquivo(NOME_RELATORIO_ERROS, erros_para_csv(erros))
+            else:
+                with open(os.path.join(destino, NOME_RELATORIO_ERROS), "wb") as f:
+                    f.write(erros_para_csv(erros))
+            print(f"{len(erros)} erro(s) registrado(s) em {NOME_RELATORIO_ERROS}.")
+        if saida_zip is not None:
+            saida_zip.finalizar()
+            saida_zip.fechar()
+
+    if saida_zip is not None and saida_zip.taxa_compressao is not None:
+        print(f"ZIP: {descrever_compressao(saida_zip)}.")
+    return gerados
+
+
+def processar_todos_xmls(
+    xml_dir,
+    templates_base_dir,
+    palavras_chave,
+    destino,
+    workers=None,
+    compressao=MODO_COMPRESSAO_PADRAO,
+    consolidar=False,
+    formato=FORMATO_SAIDA_PADRAO,
+    pular_processadas=False,
+):
+    return gravar_documentos_lote(
+        listar_xmls(xml_dir),
+        templates_base_dir,
+        palavras_chave,
+        destino,
+        workers,
+        compressao,
+        consolidar,
+        formato,
+        pular_processadas,
+    )
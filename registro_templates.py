@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import time
+
+
+DIRETORIO_TEMPLATES = os.path.dirname(os.path.abspath(__file__))
+
+NOME_MANIFESTO = "manifesto.json"
+NOME_MANIFESTO_MUNICIPIO = "municipio.json"
+
+TEMPLATES_NOTA = ("Planilha.docx", "Relatorio.docx")
+
+# Intervalo mínimo entre duas verificações de mudança nas pastas.
+INTERVALO_VERIFICACAO = 2.0
+
+
+def _ler_json(caminho):
+    with open(caminho, encoding="utf-8") as arquivo:
+        return json.load(arquivo)
+
+
+def ler_manifesto(pasta):
+    conteudo = _ler_json(os.path.join(pasta, NOME_MANIFESTO))
+    palavras_chave = conteudo.get("palavras_chave")
+    if not palavras_chave or not all(isinstance(palavra, str) and palavra.strip() for palavra in palavras_chave):
+        raise ValueError("'palavras_chave' deve ser uma lista de textos não vazia")
+    templates = conteudo.get("templates", list(TEMPLATES_NOTA))
+    if not templates or not all(isinstance(template, str) and template.strip() for template in templates):
+        raise ValueError("'templates' deve ser uma lista de nomes de arquivo não vazia")
+    return {
+        "ordem": int(conteudo.get("ordem", 0)),
+        "palavras_chave": tuple(palavra.strip().upper() for palavra in palavras_chave),
+        "templates": tuple(templates),
+    }
+
+
+_manifestos = {}
+_manifestos_lock = threading.Lock()
+
+
+def templates_da_pasta(pasta):
+    # Usado também pelos workers do pool, que não carregam o registro: lê o
+    # manifesto da pasta escolhida e o guarda até o arquivo mudar.
+    caminho = os.path.join(pasta, NOME_MANIFESTO)
+    try:
+        assinatura = os.stat(caminho).st_mtime_ns
+    except OSError:
+        return TEMPLATES_NOTA
+
+    with _manifestos_lock:
+        entrada = _manifestos.get(caminho)
+    if entrada is None or entrada[0] != assinatura:
+        try:
+            templates = ler_manifesto(pasta)["templates"]
+        except (OSError, ValueError) as e:
+            print(f"Manifesto inválido em {pasta}: {str(e)}")
+            templates = TEMPLATES_NOTA
+        entrada = (assinatura, templates)
+        with _manifestos_lock:
+            _manifestos[caminho] = entrada
+    return entrada[1]
+
+
+class Secretaria:
+    def __init__(self, nome, diretorio, palavras_chave, templates, ordem=0):
+        self.nome = nome
+        self.diretorio = diretorio
+        self.palavras_chave = palavras_chave
+        self.templates = templates
+        self.ordem = ordem
+
+
+class Cidade:
+    def __init__(self, nome, rotulo, diretorio, secretarias):
+        self.nome = nome
+        self.rotulo = rotulo
+        self.diretorio = diretorio
+        # A ordem das secretarias é a prioridade quando uma nota casa com
+        # mais de um template.
+        self.secretarias = sorted(secretarias, key=lambda secretaria: (secretaria.ordem, secretaria.nome))
+        self.palavras_chave = {
+            secretaria.nome: list(secretaria.palavras_chave) for secretaria in self.secretarias
+        }
+
+
+class RegistroTemplates:
+    def __init__(self, diretorio_base, cidades, erros, assinatura):
+        self.diretorio_base = diretorio_base
+        self.cidades = cidades
+        self.erros = erros
+        self.assinatura = assinatura
+
+    @property
+    def nomes(self):
+        return list(self.cidades)
+
+    def palavras_chave_por_cidade(self):
+        return {nome: cidade.palavras_chave for nome, cidade in self.cidades.items()}
+
+
+def _subpastas(diretorio):
+    try:
+        return sorted(
+            entrada.name
+            for entrada in os.scandir(diretorio)
+            if entrada.is_dir() and not entrada.name.startswith((".", "_"))
+        )
+    except OSError:
+        return []
+
+
+def _assinatura(diretorio_base):
+    # Muda quando uma pasta é criada ou removida ou quando algum manifesto é
+    # editado; não olha os .docx, que já são validados pelo cache de templates.
+    partes = []
+    for caminho in [diretorio_base] + [os.path.join(diretorio_base, cidade) for cidade in _subpastas(diretorio_base)]:
+        try:
+            partes.append((caminho, os.stat(caminho).st_mtime_ns))
+        except OSError:
+            continue
+        for nome in (NOME_MANIFESTO_MUNICIPIO,) + tuple(
+            os.path.join(pasta, NOME_MANIFESTO) for pasta in _subpastas(caminho)
+        ):
+            manifesto = os.path.join(caminho, nome)
+            try:
+                partes.append((manifesto, os.stat(manifesto).st_mtime_ns))
+            except OSError:
+                continue
+    return tuple(partes)
+
+
+def carregar_registro(diretorio_base=DIRETORIO_TEMPLATES):
+    diretorio_base = os.path.abspath(diretorio_base)
+    assinatura = _assinatura(diretorio_base)
+    cidades = {}
+    erros = []
+
+    for nome_cidade in _subpastas(diretorio_base):
+        cidade_dir = os.path.join(diretorio_base, nome_cidade)
+        pastas = _subpastas(cidade_dir)
+        # Só é cidade a pasta que tem ao menos uma secretaria com manifesto.
+        if not any(os.path.exists(os.path.join(cidade_dir, pasta, NOME_MANIFESTO)) for pasta in pastas):
+            continue
+
+        secretarias = []
+        for pasta in pastas:
+            pasta_dir = os.path.join(cidade_dir, pasta)
+            if not os.path.exists(os.path.join(pasta_dir, NOME_MANIFESTO)):
+                erros.append(f"Pasta '{pasta_dir}' sem {NOME_MANIFESTO}; ignorada.")
+                continue
+            try:
+                manifesto = ler_manifesto(pasta_dir)
+            except (OSError, ValueError) as e:
+                erros.append(f"Manifesto inválido em '{pasta_dir}': {e}")
+                continue
+            for template_name in manifesto["templates"]:
+                if not os.path.exists(os.path.join(pasta_dir, template_name)):
+                    erros.append(f"Template '{os.path.join(pasta_dir, template_name)}' não encontrado.")
+            secretarias.append(
+                Secretaria(pasta, pasta_dir, manifesto["palavras_chave"], manifesto["templates"], manifesto["ordem"])
+            )
+
+        rotulo = nome_cidade.title()
+        manifesto_municipio = os.path.join(cidade_dir, NOME_MANIFESTO_MUNICIPIO)
+        if os.path.exists(manifesto_municipio):
+            try:
+                rotulo = _ler_json(manifesto_municipio).get("nome") or rotulo
+            except (OSError, ValueError) as e:
+                erros.append(f"Manifesto inválido em '{manifesto_municipio}': {e}")
+
+        if secretarias:
+            cidades[nome_cidade] = Cidade(nome_cidade, rotulo, cidade_dir, secretarias)
+
+    return RegistroTemplates(diretorio_base, cidades, erros, assinatura)
+
+
+_registros = {}
+_registros_lock = threading.Lock()
+
+
+def obter_registro(diretorio_base=DIRETORIO_TEMPLATES):
+    # O registro é montado uma vez e reaproveitado entre reruns; a cada
+    # INTERVALO_VERIFICACAO segundos confere se alguma pasta ou manifesto
+    # mudou e, se mudou, recarrega sem precisar reiniciar o servidor.
+    diretorio_base = os.path.abspath(diretorio_base)
+    agora = time.monotonic()
+    with _registros_lock:
+        entrada = _registros.get(diretorio_base)
+        if entrada is not None and agora - entrada[1] < INTERVALO_VERIFICACAO:
+            return entrada[0]
+
+    if entrada is not None and entrada[0].assinatura == _assinatura(diretorio_base):
+        registro = entrada[0]
+    else:
+        registro = carregar_registro(diretorio_base)
+
+    with _registros_lock:
+        _registros[diretorio_base] = (registro, agora)
+    return registro
@@ -0,0 +1,308 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from agendador import obter_agendador
+from conversao_pdf import FORMATO_SAIDA_PADRAO, EtapaPdf
+from historico_notas import marcar_notas_processadas, obter_historico, registrar_resultado
+from metricas import NOME_RELATORIO_ERROS, ColetorMetricas, PerfilExecucao, descrever_erro, erros_para_csv
+from pacotes_xml import contar_xmls
+from processamento import (
+    MODO_COMPRESSAO_PADRAO,
+    ConsolidacaoLote,
+    ZipEmStreaming,
+    descrever_resultado,
+    iterar_notas,
+    numero_workers_padrao,
+    processar_lote,
+)
+
+
+LIMITE_ITENS_IDENTIFICADOS = 50
+# Lotes concluídos continuam disponíveis para download depois dos reruns,
+# até a mesma sessão enviar outro lote ou passar este tempo (sessões
+# abandonadas).
+RETENCAO_TAREFAS = float(os.environ.get("ASPDOC_TAREFAS_RETENCAO_HORAS", "12")) * 3600
+
+ESTADOS_ATIVOS = ("na_fila", "executando")
+
+
+class Tarefa:
+    # Um lote rodando numa thread própria, fora da execução do script do
+    # Streamlit: os reruns só consultam o estado e o ZIP pronto fica guardado.
+    # A thread espera a vez no agendador do servidor antes de começar.
+    def __init__(
+        self,
+        cidade,
+        xmls,
+        templates_base_dir,
+        palavras_chave,
+        workers=None,
+        perfil=False,
+        avisos=None,
+        compressao=MODO_COMPRESSAO_PADRAO,
+        consolidar=False,
+        formato=FORMATO_SAIDA_PADRAO,
+        pular_processadas=False,
+        agendador=None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.cidade = cidade
+        self.xmls = xmls
+        self.templates_base_dir = templates_base_dir
+        self.palavras_chave = palavras_chave
+        self.workers = 1 if perfil else workers or numero_workers_padrao()
+        self.perfil = perfil
+        self.compressao = compressao
+        self.consolidar = consolidar
+        self.formato = formato
+        self.pular_processadas = pular_processadas
+        self.agendador = agendador or obter_agendador()
+        self.estado = "na_fila"
+        self.total_arquivos = len(xmls)
+        self.arquivos_lidos = 0
+        self.notas_concluidas = 0
+        self.documentos_em_cache = 0
+        self.ultimo_arquivo = None
+        self.identificados = deque(maxlen=LIMITE_ITENS_IDENTIFICADOS)
+        self.avisos = list(avisos or [])
+        self.erros = []
+        self.erro = None
+        self.zip_saida = None
+        self.coletor = None
+        self.concluida_em = None
+        self._cancelar = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._executar, name=f"aspdoc-{self.id[:8]}", daemon=True)
+
+    @property
+    def ativa(self):
+        return self.estado in ESTADOS_ATIVOS
+
+    def iniciar(self):
+        self._thread.start()
+        return self
+
+    def cancelar(self):
+        self._cancelar.set()
+        # Uma tarefa ainda na fila sai dela na hora.
+        self.agendador.acordar()
+
+    def aguardar(self, timeout=None):
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def instantaneo(self):
+        with self._lock:
+            return {
+                "estado": self.estado,
+                "posicao_fila": self.agendador.posicao(self) if self.estado == "na_fila" else 0,
+                "total_arquivos": self.total_arquivos,
+                "arquivos_lidos": self.arquivos_lidos,
+                "notas_concluidas": self.notas_concluidas,
+                "documentos_em_cache": self.documentos_em_cache,
+                "ultimo_arquivo": self.ultimo_arquivo,
+                "identificados": list(self.identificados),
+                "avisos": list(self.avisos),
+                "erros": list(self.erros),
+                "erro": self.erro,
+                "documentos_gravados": self.zip_saida.total_documentos if self.zip_saida is not None else 0,
+            }
+
+    def _executar(self):
+        try:
+            if not self.agendador.aguardar_vez(self, self._cancelar):
+                self.xmls = None
+                self.estado = "cancelada"
+                return
+            try:
+                self._processar()
+            finally:
+                self.agendador.liberar(self)
+        finally:
+            self.concluida_em = time.monotonic()
+
+    def _processar(self):
+        coletor = ColetorMetricas()
+        zip_saida = None
+        etapa_pdf = None
+        perfil_execucao = None
+        # Tudo, inclusive a preparação, fica dentro do try: uma falha em
+        # qualquer ponto precisa tirar a tarefa de "executando".
+        try:
+            # Criado antes do lote para que um ZIP parcial possa ser baixado a
+            # qualquer momento.
+            zip_saida = ZipEmStreaming(modo=self.compressao)
+            self.zip_saida = zip_saida
+            self.estado = "executando"
+            # Com pacotes .zip/.tar.gz o total de XMLs só é conhecido aqui.
+            self.total_arquivos = contar_xmls(self.xmls)
+            consolidacao = ConsolidacaoLote(self.templates_base_dir) if self.consolidar else None
+            etapa_pdf = EtapaPdf(self.formato)
+            perfil_execucao = PerfilExecucao(self.perfil)
+            historico = obter_historico()
+            with perfil_execucao:
+                lote = processar_lote(
+                    marcar_notas_processadas(
+                        iterar_notas(self.xmls), historico, self.cidade, self.pular_processadas
+                    ),
+                    self.templates_base_dir,
+                    self.palavras_chave,
+                    self.workers,
+                    consolidar=self.consolidar,
+                    memoria=self.agendador.memoria,
+                )
+                try:
+                    for indice, resultado in lote:
+                        coletor.registrar(indice, resultado)
+                        erros_historico = registrar_resultado(historico, self.cidade, resultado)
+                        for pronto, documentos in etapa_pdf.adicionar(indice, resultado["documentos"]):
+                            zip_saida.adicionar(pronto, documentos)
+                        if consolidacao is not None:
+                            consolidacao.registrar(indice, resultado)
+                        with self._lock:
+                            self.notas_concluidas += 1
+                            self.documentos_em_cache += resultado["em_cache"]
+                            self.arquivos_lidos = max(self.arquivos_lidos, resultado["indice_arquivo"] + 1)
+                            self.ultimo_arquivo = resultado["arquivo"]
+                            self.avisos.extend(resultado["avisos"])
+                            self.erros.extend(resultado["erros"])
+                            self.erros.extend(erros_historico)
+                            self._registrar_pdf(etapa_pdf)
+                            if resultado["template"] is not None:
+                                self.identificados.append(descrever_resultado(resultado))
+                        if self._cancelar.is_set():
+                            break
+                finally:
+                    # Fechar o gerador cancela as notas ainda na fila do pool.
+                    lote.close()
+
+                if not self._cancelar.is_set():
+                    for pronto, documentos in etapa_pdf.finalizar():
+                        zip_saida.adicionar(pronto, documentos)
+                    if consolidacao is not None:
+                        avisos = []
+                        erros = []
+                        documentos = consolidacao.gerar_documentos(avisos, erros=erros)
+                        zip_saida.adicionar_documentos(etapa_pdf.converter(documentos))
+                        with self._lock:
+                            self.avisos.extend(avisos)
+                            self.erros.extend(erros)
+                    with self._lock:
+                        self._registrar_pdf(etapa_pdf)
+        except Exception as e:
+            print(f"Erro ao processar o lote {self.id}: {str(e)}")
+            self.erro = str(e)
+            with self._lock:
+                self.erros.append(descrever_erro(self.ultimo_arquivo, "lote", e))
+        finally:
+            if etapa_pdf is not None:
+                etapa_pdf.cancelar()
+            # Os buffers dos uploads não são mais necessários.
+            self.xmls = None
+
+        if zip_saida is None:
+            self.estado = "erro"
+            return
+
+        # Com erro ou cancelamento, as notas já concluídas continuam no ZIP.
+        try:
+            if etapa_pdf is not None:
+                coletor.registrar_pdf(etapa_pdf.tempos)
+            coletor.registrar_zip(zip_saida.tempos)
+            coletor.finalizar()
+            if self.perfil and perfil_execucao is not None:
+                arquivos_perfil = perfil_execucao.arquivos()
+                arquivos_perfil += [("tempos.json", coletor.para_json()), ("tempos.csv", coletor.para_csv())]
+                for nome_arquivo, conteudo in arquivos_perfil:
+                    zip_saida.adicionar_arquivo(f"_perfil/{nome_arquivo}", conteudo)
+            if self.erros:
+                zip_saida.adicionar_arquivo(NOME_RELATORIO_ERROS, erros_para_csv(self.erros))
+            zip_saida.finalizar()
+        except Exception as e:
+            print(f"Erro ao finalizar o ZIP do lote {self.id}: {str(e)}")
+            zip_saida.fechar()
+            self.zip_saida = None
+            self.erro = self.erro or str(e)
+            self.estado = "erro"
+            return
+
+        self.coletor = coletor
+        if self.erro is not None:
+            self.estado = "erro"
+        elif self._cancelar.is_set():
+            self.estado = "cancelada"
+        else:
+            self.estado = "concluida"
+
+    def _registrar_pdf(self, etapa_pdf):
+        self.avisos.extend(etapa_pdf.retirar_avisos())
+        self.erros.extend(etapa_pdf.retirar_erros())
+
+    def descartar(self):
+        self.cancelar()
+        if self.zip_saida is not None:
+            self.zip_saida.fechar()
+            self.zip_saida = None
+
+
+_tarefas = OrderedDict()
+_tarefas_lock = threading.Lock()
+
+
+def _descartar_expiradas():
+    # Chamada com _tarefas_lock.
+    limite = time.monotonic() - RETENCAO_TAREFAS
+    expiradas = [
+        chave
+        for chave, tarefa in _tarefas.items()
+        if not tarefa.ativa and tarefa.concluida_em is not None and tarefa.concluida_em < limite
+    ]
+    for chave in expiradas:
+        _tarefas.pop(chave).descartar()
+
+
+def enviar_tarefa(
+    cidade,
+    xmls,
+    templates_base_dir,
+    palavras_chave,
+    workers=None,
+    perfil=False,
+    avisos=None,
+    compressao=MODO_COMPRESSAO_PADRAO,
+    consolidar=False,
+    formato=FORMATO_SAIDA_PADRAO,
+    pular_processadas=False,
+    anterior_id=None,
+):
+    # `anterior_id` é a tarefa que a sessão acompanhava: o novo lote a
+    # substitui. As de outras sessões só saem pelo tempo.
+    tarefa = Tarefa(
+        cidade,
+        xmls,
+        templates_base_dir,
+        palavras_chave,
+        workers,
+        perfil,
+        avisos,
+        compressao,
+        consolidar,
+        formato,
+        pular_processadas,
+    )
+    with _tarefas_lock:
+        anterior = _tarefas.get(anterior_id)
+        if anterior is not None and not anterior.ativa:
+            _tarefas.pop(anterior_id).descartar()
+        _descartar_expiradas()
+        _tarefas[tarefa.id] = tarefa
+    return tarefa.iniciar()
+
+
+def obter_tarefa(tarefa_id):
+    with _tarefas_lock:
+        _descartar_expiradas()
+        return _tarefas.get(tarefa_id)
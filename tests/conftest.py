@@ -0,0 +1,7 @@
+import os
+
+
+# Os testes renderizam de verdade: nada vem do cache de documentos nem vai
+# para o histórico de quem roda a suíte.
+os.environ.setdefault("ASPDOC_CACHE_RESULTADOS", "0")
+os.environ.setdefault("ASPDOC_HISTORICO", "0")
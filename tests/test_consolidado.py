@@ -0,0 +1,77 @@
+import io
+import os
+import zipfile
+from decimal import Decimal
+
+import pytest
+from lxml import etree
+
+from benchmarks.pipeline import gerar_notas
+from cache_templates import NAMESPACE_W, PADRAO_ROTULO_TOTAL
+from processamento import gerar_documentos_em_memoria, iterar_notas, montar_dados_consolidados, processar_nota
+from registro_templates import obter_registro
+
+
+def linhas_das_tabelas(conteudo):
+    with zipfile.ZipFile(io.BytesIO(conteudo)) as pacote:
+        raiz = etree.fromstring(pacote.read("word/document.xml"))
+    return [
+        ["".join(celula.itertext()).strip() for celula in linha.iter(f"{NAMESPACE_W}tc")]
+        for linha in raiz.iter(f"{NAMESPACE_W}tr")
+    ]
+
+
+def eh_total(linha):
+    return PADRAO_ROTULO_TOTAL.search(" ".join(linha)) is not None
+
+
+def notas_por_secretaria(nome_cidade):
+    cidade = obter_registro().cidades[nome_cidade]
+    xmls = [(nome_arquivo, xml) for nome, nome_arquivo, xml in gerar_notas(120) if nome == nome_cidade]
+    notas = {}
+    for unidade in iterar_notas(xmls):
+        resultado = processar_nota(unidade, cidade.diretorio, cidade.palavras_chave, consolidar=True)
+        if resultado.get("nota") is not None:
+            notas.setdefault(resultado["template"], []).append(resultado["nota"])
+    return cidade, notas
+
+
+@pytest.mark.parametrize("nome_cidade", ["MARACANAU", "PACATUBA"])
+def test_planilhas_consolidadas(nome_cidade):
+    # Compara cada Planilha do lote com a mesma Planilha de uma nota só: a
+    # linha de dados se repete uma vez por nota, as linhas de TOTAL do
+    # template aparecem uma única vez (ou, sem nenhuma, ganha-se uma) e a
+    # "QUANTIDADE TOTAL" traz a soma das quantidades do lote.
+    cidade, notas_secretarias = notas_por_secretaria(nome_cidade)
+    assert notas_secretarias
+    for template_folder, notas in sorted(notas_secretarias.items()):
+        template_dir = os.path.join(cidade.diretorio, template_folder)
+        dados = montar_dados_consolidados(notas)
+        de_uma_nota = dict(gerar_documentos_em_memoria(template_dir, notas[0]["dados"], template_folder))
+        for nome_arquivo, conteudo in gerar_documentos_em_memoria(template_dir, dados, template_folder, consolidado=True):
+            if not nome_arquivo.startswith(f"{template_folder}_Planilha"):
+                continue
+            linhas = linhas_das_tabelas(conteudo)
+            originais = linhas_das_tabelas(de_uma_nota[nome_arquivo])
+            tem_total = any(eh_total(linha) for linha in originais)
+            assert len(linhas) == len(originais) + len(notas) - 1 + (0 if tem_total else 1), nome_arquivo
+            rotulos = [linha[0] for linha in linhas if eh_total(linha)]
+            assert len(rotulos) == len(set(rotulos)), nome_arquivo
+            for linha in linhas:
+                if linha[0].upper() == "QUANTIDADE TOTAL":
+                    assert linha[-1] == dados["quant"], nome_arquivo
+
+
+def test_nota_sem_numero_usa_o_nome_do_xml():
+    nota = {
+        "arquivo": "lote.zip/pasta/nfse_7.xml",
+        "dados": {"numeroNF": None, "quant": "3"},
+        "valor": Decimal("10.00"),
+        "data": None,
+        "competencia": None,
+    }
+    outra = dict(nota, arquivo="nfse_8.xml", dados={"numeroNF": "8", "quant": "2"})
+    dados = montar_dados_consolidados([nota, outra])
+    assert dados["numeroNF"] == "nfse_7, 8"
+    assert [item["numeroNF"] for item in dados["notas"]] == ["nfse_7", "8"]
+    assert dados["quant"] == "5"
@@ -0,0 +1,20 @@
+import statistics
+
+from benchmarks.importacao import MODULOS_SOB_DEMANDA, ORCAMENTO_PADRAO_MS, importar_a_frio
+
+
+def test_importacao_do_app_dentro_do_orcamento():
+    # Mediana de três interpretadores novos, para uma medição isolada mais
+    # lenta (disco frio, máquina ocupada) não reprovar a suíte.
+    totais = []
+    for _ in range(3):
+        linhas = importar_a_frio("app")
+        totais.append(next(acumulado for nome, _, acumulado, _ in linhas if nome == "app"))
+    total = statistics.median(totais)
+    assert total <= ORCAMENTO_PADRAO_MS, f"a importação levou {total:.1f} ms (orçamento {ORCAMENTO_PADRAO_MS:.0f} ms)"
+
+
+def test_importacao_do_app_nao_traz_modulos_sob_demanda():
+    linhas = importar_a_frio("app")
+    carregados = sorted({nome for nome, _, _, _ in linhas} & set(MODULOS_SOB_DEMANDA))
+    assert carregados == []
@@ -0,0 +1,76 @@
+import io
+import random
+import zipfile
+import zlib
+
+import pytest
+
+import processamento
+from processamento import MODOS_COMPRESSAO, ZipEmStreaming, nome_unico
+
+
+def gerar_documentos(quantidade, semente=42):
+    # Metade texto repetido (comprime bem), metade bytes aleatórios (não
+    # comprime), como um lote com DOCX e PDF.
+    aleatorio = random.Random(semente)
+    documentos = []
+    for indice in range(quantidade):
+        if indice % 2:
+            tamanho = aleatorio.randint(0, 64 * 1024)
+            conteudo = aleatorio.getrandbits(tamanho * 8).to_bytes(tamanho, "little")
+        else:
+            conteudo = f"NFS-e {indice} ".encode("utf-8") * aleatorio.randint(1, 4000)
+        documentos.append((indice, [(f"{indice:04d}_Planilha.docx", conteudo), ("repetido.docx", conteudo[:100])]))
+    return documentos
+
+
+def nomes_unicos(arquivos):
+    usados = set()
+    return [(nome_unico(nome, usados), dados) for nome, dados in arquivos]
+
+
+def tamanho_comprimido(dados, nivel):
+    if nivel is None:
+        return len(dados)
+    compressor = zlib.compressobj(nivel, zlib.DEFLATED, -15)
+    return len(compressor.compress(dados) + compressor.flush())
+
+
+def conferir(conteudo, esperados, nivel):
+    # Abre o ZIP como um leitor qualquer e confere CRC, nomes, conteúdo e o
+    # nível de compressão do modo.
+    with zipfile.ZipFile(io.BytesIO(conteudo)) as pacote:
+        assert pacote.testzip() is None
+        assert pacote.namelist() == [nome for nome, _ in esperados]
+        for nome, dados in esperados:
+            assert pacote.read(nome) == dados
+            assert pacote.getinfo(nome).compress_size == tamanho_comprimido(dados, nivel), nome
+
+
+@pytest.mark.parametrize("usar_internos", [True, False], ids=["internos", "api_publica"])
+@pytest.mark.parametrize("modo", list(MODOS_COMPRESSAO))
+@pytest.mark.parametrize("saida", ["memoria", "temporario", "arquivo"])
+def test_zip_parcial_e_final(monkeypatch, tmp_path, usar_internos, modo, saida):
+    # Entrega as notas fora de ordem, lê o ZIP parcial na metade e no fim
+    # compara o ZIP final com os documentos na ordem do lote.
+    monkeypatch.setattr(processamento, "USAR_INTERNOS_ZIP", usar_internos)
+    documentos = gerar_documentos(40)
+    if saida == "arquivo":
+        zip_saida = ZipEmStreaming(destino=str(tmp_path / f"{modo}.zip"), modo=modo)
+    else:
+        zip_saida = ZipEmStreaming(limite_memoria=64 * 1024 if saida == "temporario" else 64 * 1024 * 1024, modo=modo)
+    nivel = MODOS_COMPRESSAO[modo][1]
+    ordem = list(documentos)
+    random.Random(len(documentos)).shuffle(ordem)
+    try:
+        for posicao, (indice, arquivos) in enumerate(ordem):
+            zip_saida.adicionar(indice, arquivos)
+            if posicao == len(ordem) // 2:
+                gravados = [item for _, arquivos_nota in documentos[: zip_saida._proximo] for item in arquivos_nota]
+                conferir(zip_saida.ler_parcial(), nomes_unicos(gravados), nivel)
+        zip_saida.finalizar()
+        esperados = nomes_unicos([item for _, arquivos in documentos for item in arquivos])
+        conferir(zip_saida.ler(), esperados, nivel)
+        conferir(zip_saida.ler_parcial(), esperados, nivel)
+    finally:
+        zip_saida.fechar()